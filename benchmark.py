@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from os import path
+from datetime import datetime, timedelta
+
+#Benchmarks of the steps from weather.csv to the frame of the display. The
+#weather files are made up with generate_weather_csv, from a day to years of
+#rows, so it shows how the times grow with the length of the log. The results
+#can be saved as JSON and compared against limits or an earlier run.
+
+#The devices display_continuous.py shows, the rest are made up
+DEVICES = ["e6:89:18:c1:32:1f", "fc:41:f4:c5:0c:08"]
+
+#Writes a readRuuvi.py style CSV: the device names, the labels, and a row
+#every interval seconds for the given number of days, ending at end (now by
+#default). Each device has humidity, temperature, pressure and battery.
+def generate_weather_csv(filename, days, n_devices=2, interval=300, end=None, seed=0):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    devices = (DEVICES+["{:02x}:00:00:00:00:{:02x}".format(ind, ind) for ind in range(len(DEVICES), n_devices)])[:n_devices]
+    if end is None:
+        end = datetime.now().replace(microsecond=0)
+    n_rows = int(days*86400/interval)
+    seconds = np.arange(-n_rows+1, 1)*interval
+    #A daily cycle and a slow wander, different for every device
+    columns = []
+    for ind in range(n_devices):
+        day_cycle = np.sin(2*np.pi*seconds/86400+ind)
+        wander = np.cumsum(rng.normal(0, 0.05, n_rows))
+        temp = 5+8*day_cycle+wander
+        humidi = np.clip(60-10*day_cycle+rng.normal(0, 1, n_rows), 0, 100)
+        pressure = 100000+np.cumsum(rng.normal(0, 5, n_rows))
+        battery = np.full(n_rows, 3000)
+        columns += [np.char.mod("%.2f", humidi), np.char.mod("%.2f", temp),
+                    np.char.mod("%.0f", pressure), np.char.mod("%d", battery)]
+    times = (np.datetime64(end, 's')+seconds.astype('timedelta64[s]')).astype(str)
+    #"2023-03-31T12:00:00" to "2023-03-31,12:00:00"
+    rows = np.char.replace(times, "T", ",")
+    for column in columns:
+        rows = np.char.add(np.char.add(rows, ","), column)
+    with open(filename, "w") as fil:
+        fil.write(",".join(devices)+"\n")
+        fil.write(",".join(["Date", "Time"]+["Humidity[%]", "Temperature[C]", "Pressure[Pa]", "Battery[mV]"]*n_devices)+"\n")
+        fil.write("\n".join(rows.tolist())+"\n")
+    return n_rows
+
+#Appends one new row to the end of a file made by generate_weather_csv
+def append_weather_row(filename):
+    with open(filename, "rb") as fil:
+        fil.seek(-2, os.SEEK_END)
+        while fil.read(1)!=b"\n":
+            fil.seek(-2, os.SEEK_CUR)
+        last = fil.readline().decode("utf-8").rstrip("\n").split(",")
+    row_time = datetime.fromisoformat(last[0]+"T"+last[1])+timedelta(seconds=300)
+    with open(filename, "a") as fil:
+        fil.write(",".join([str(row_time.date()), str(row_time.time())]+last[2:])+"\n")
+
+#Runs func repeat times, with setup before each run outside the timing, and
+#gives the times in seconds
+def measure(func, repeat, setup=None):
+    times = []
+    for ind in range(repeat):
+        if setup:
+            setup()
+        timing1 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-timing1)
+    return times
+
+#Gives the button gestures to a mock ButtonEvents as presses with contact
+#bounce, both when pressed and let go, and gives the times from the last edge
+#to the decoded gesture. A bounce counted as a press is an error.
+def measure_button_gestures(button_events, repeat, bounce=0.005, hold=0.1):
+    times = []
+    for (presses, expected) in (([1], (1, 0)), ([1, 1], (2, 0)), ([2, 2, 2], (0, 3))):
+        for ind in range(repeat):
+            for button in presses:
+                for edge in (button_events.press, button_events.release, button_events.press):
+                    edge(button)
+                    time.sleep(bounce)
+                time.sleep(hold)
+                for edge in (button_events.release, button_events.press, button_events.release):
+                    edge(button)
+                    time.sleep(bounce)
+                time.sleep(hold)
+            timing1 = time.perf_counter()
+            gesture = button_events.wait(5)
+            times.append(time.perf_counter()-timing1)
+            if gesture!=expected:
+                raise ValueError("Presses {} gave the gesture {}, not {}".format(presses, gesture, expected))
+    return times
+
+#Runs the benchmarks on a weather file of each length in days_list. Gives
+#{name: summary}, the names end with the length of the file in days.
+def run_benchmarks(days_list, repeat, workdir, plot_backends=("matplotlib", "pil")):
+    sys.path.insert(0, path.dirname(path.abspath(__file__)))
+    import drawWeather
+    import display_continuous as dc
+    import metrics
+    import sunCalc
+    import virtualHardware
+    Image = dc.Image
+    ImageDraw = dc.ImageDraw
+
+    results = {}
+    def record(name, times):
+        results[name] = metrics.summarize(times)
+        print("{:48s} median {:9.2f} ms  min {:9.2f} ms".format(name, results[name]["median"]*1000, results[name]["min"]*1000))
+
+    #A picture like the ones of the picture folder
+    pic_file = path.join(workdir, "picture.png")
+    picture = Image.new("RGB", (400, 400), color=dc.WHITE)
+    ImageDraw.Draw(picture).ellipse((50, 50, 350, 350), fill=dc.BLACK)
+    picture.save(pic_file)
+
+    display = virtualHardware.VirtualSSD1680(122, 250, l_full_busy=0, l_partial_busy=0, l_baudrate=float("inf"))
+    display.rotation = 1
+
+    for days in days_list:
+        weather_file = path.join(workdir, "weather_{}.csv".format(days))
+        timing1 = time.perf_counter()
+        n_rows = generate_weather_csv(weather_file, days)
+        print("{} days: {} rows, {:.1f} MB, generated in {:.1f} s".format(
+            days, n_rows, path.getsize(weather_file)/1e6, time.perf_counter()-timing1))
+
+        def clear_header():
+            drawWeather._header_cache.clear()
+        record("get_weather_data_cold_{}d".format(days),
+               measure(lambda: drawWeather.get_weather_data(weather_file, DEVICES[1], 1), repeat, clear_header))
+
+        follower = drawWeather.WeatherFollower(weather_file, 1)
+        follower.get_weather_data(DEVICES[1])
+        record("follower_new_row_{}d".format(days),
+               measure(lambda: follower.get_weather_data(DEVICES[1]), repeat, lambda: append_weather_row(weather_file)))
+
+        sidecar = drawWeather.WeatherSidecar(weather_file)
+        record("sidecar_update_full_{}d".format(days), measure(sidecar.update, 1))
+        record("sidecar_get_weather_data_{}d".format(days),
+               measure(lambda: sidecar.get_weather_data(DEVICES[1], 1), repeat))
+
+        (meas_time, temp) = drawWeather.get_weather_data(weather_file, DEVICES[1], 1)[:2]
+        for backend in plot_backends:
+            plot = dc.make_plot_image if backend=="matplotlib" else dc.make_plot_image_pil
+            record("make_plot_image_{}_{}d".format(backend, days),
+                   measure(lambda: plot(meas_time, temp, 150, 70), repeat))
+
+            image_manip = dc.WeatherImageManipulations(weather_file, DEVICES[0], DEVICES[1],
+                                                       display.width, display.height)
+            image_manip.set_plot_backend(backend)
+            def empty_caches():
+                image_manip.set_plot_cache(dc.ImageCache())
+                image_manip.set_pic_cache(dc.ImageCache())
+            record("create_weather_image_uncached_{}_{}d".format(backend, days),
+                   measure(lambda: image_manip.create_weather_image(pic_file), repeat, empty_caches))
+            record("create_weather_image_cached_{}_{}d".format(backend, days),
+                   measure(lambda: image_manip.create_weather_image(pic_file, True, False), repeat))
+
+    image_manip = dc.WeatherImageManipulations(weather_file, DEVICES[0], DEVICES[1],
+                                               display.width, display.height)
+    sun_table = sunCalc.SunTable()
+    record("sun_table_year", measure(sunCalc.SunTable, repeat))
+    record("create_sun_image",
+           measure(lambda: image_manip.create_sun_image("finland", "jyvaskyla", sun_table.sun_info()), repeat))
+
+    frame = image_manip.create_weather_image(pic_file)
+    record("pack_image", measure(lambda: dc.pack_image(display, frame), repeat))
+
+    #Each gesture takes a second, a few are enough
+    button_events = dc.ButtonEvents((None, None), (None, None), "mock")
+    record("button_gesture", measure_button_gestures(button_events, min(repeat, 3)))
+    return results
+
+#Gives the names of the results that are over their limit in thresholds
+#({name: seconds}), or slower than tolerance times the same result in baseline
+def find_regressions(results, thresholds=None, baseline=None, tolerance=1.5):
+    regressions = []
+    for (name, summary) in results.items():
+        if thresholds and name in thresholds and summary["median"]>thresholds[name]:
+            regressions.append("{}: {:.2f} ms, limit {:.2f} ms".format(
+                name, summary["median"]*1000, thresholds[name]*1000))
+        if baseline and name in baseline and summary["median"]>tolerance*baseline[name]["median"]:
+            regressions.append("{}: {:.2f} ms, baseline {:.2f} ms".format(
+                name, summary["median"]*1000, baseline[name]["median"]*1000))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks reading the weather file, plotting, drawing the frames and packing them for the display, on made up weather files of different lengths.",
+                                     epilog="Created by OS")
+    parser.add_argument("--days",
+                        "-d",
+                        help="Lengths of the generated weather files in days.",
+                        nargs="+",
+                        type=int,
+                        default=[1, 30, 365, 1095])
+    parser.add_argument("--repeat",
+                        "-r",
+                        help="How many times each benchmark is run.",
+                        type=int,
+                        default=10)
+    parser.add_argument("--workdir",
+                        "-w",
+                        help="Folder for the generated files, a temporary one by default.",
+                        default=None)
+    parser.add_argument("--output",
+                        "-o",
+                        help="Write the results as JSON to this file.",
+                        default=None)
+    parser.add_argument("--thresholds",
+                        "-t",
+                        help="JSON file of {benchmark: seconds}, a slower median is a regression.",
+                        default=None)
+    parser.add_argument("--baseline",
+                        "-b",
+                        help="JSON results of an earlier run, a median slower than --tolerance times the baseline is a regression.",
+                        default=None)
+    parser.add_argument("--tolerance",
+                        help="Allowed slowdown against --baseline.",
+                        type=float,
+                        default=1.5)
+    parser.add_argument("--generate",
+                        "-g",
+                        help="Only write a weather file of --days[0] days to this file.",
+                        default=None)
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_weather_csv(args.generate, args.days[0])
+        exit()
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args.days, args.repeat, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(args.days, args.repeat, workdir)
+
+    if args.output:
+        with open(args.output, "w") as fil:
+            json.dump({"date": datetime.now().isoformat(timespec="seconds"),
+                       "days": args.days,
+                       "repeat": args.repeat,
+                       "results": results}, fil, indent=1)
+
+    thresholds = None
+    baseline = None
+    if args.thresholds:
+        with open(args.thresholds) as fil:
+            thresholds = json.load(fil)
+    if args.baseline:
+        with open(args.baseline) as fil:
+            baseline = json.load(fil)["results"]
+    regressions = find_regressions(results, thresholds, baseline, args.tolerance)
+    for regression in regressions:
+        print("Regression:", regression)
+    if regressions:
+        exit(1)
@@ -1,9 +1,6 @@
 #!/bin/bash
 
-stat_str="$(ps aux | grep -e display_continuous.py | grep -v grep)"
-echo $stat_str
-
-if [ "$stat_str" == "" ]; then
-    echo "Restarting display_continuous.py instance"
-    /home/piirakka/e-display/display_continuous.py -r > /home/piirakka/e-display/cron_out_con.txt 2>&1 &
-fi
+#The supervisor keeps display_continuous.py running and restarts it if it
+#dies or hangs. A second supervisor exits at once, so this can be ran from
+#cron every few minutes without looking through ps.
+/home/piirakka/e-display/supervisor.py -- -r >> /home/piirakka/e-display/cron_out_con.txt 2>&1 &
@@ -9,68 +9,492 @@ WHITE = (255, 255, 255)
 BLACK = (0, 0, 0) # value over 120 is considered white
 
 import time
-import digitalio
-import busio
-import board
-from adafruit_epd.ssd1680 import Adafruit_SSD1680
-from adafruit_epd.epd import Adafruit_EPD
-from PIL import Image, ImageDraw, ImageFont
-from os import walk
+_process_start = time.perf_counter()
+import sys
+import importlib
+import threading
+
+#How long each module took to import, name: seconds. Heavy modules are only
+#imported when a code path first needs them, so this shows what the time to
+#the first frame was spent on (like python -X importtime, see --importtime).
+#Every import after this point is timed by _ImportTimer, also the ones made
+#inside drawWeather.py or sunCalc.py, like numpy. The time of a module
+#includes the modules it imports, which are not listed separately.
+import_times = {}
+
+#Runs the loading of a module in place of its loader, timing it
+class _TimedLoader:
+    def __init__(self,l_loader,l_timer):
+        self.loader=l_loader
+        self.timer=l_timer
+
+    def create_module(self,spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self,module):
+        #The module keeps its own loader, which has get_data() and the rest
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.timer.depth.value = getattr(self.timer.depth, "value", 0)+1
+        timing1 = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer.depth.value -= 1
+            if self.timer.depth.value==0:
+                import_times[module.__name__] = time.perf_counter()-timing1
+
+#Finds the modules with the other finders and times the outermost imports
+class _ImportTimer:
+    def __init__(self):
+        self.depth=threading.local()
+
+    def find_spec(self,fullname,path=None,target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimedLoader(spec.loader, self)
+            return spec
+        return None
+
+sys.meta_path.insert(0, _ImportTimer())
+
+#Imports a module, or gives the already imported one. The time is recorded by
+#_ImportTimer.
+def timed_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return importlib.import_module(name)
+
+#Prints the import times and the time from the start of the process to now.
+#The imports under a millisecond are summed on one line.
+def print_import_report():
+    print("Import times:")
+    small = [seconds for seconds in import_times.values() if seconds<0.001]
+    for (name, seconds) in sorted(import_times.items(), key=lambda item: -item[1]):
+        if seconds>=0.001:
+            print("{:9.1f} ms  {}".format(seconds*1000, name))
+    if small:
+        print("{:9.1f} ms  {} smaller imports".format(sum(small)*1000, len(small)))
+    print("Time to first frame: {:.3f} s".format(time.perf_counter()-_process_start))
+
+#The error is raised again if the hardware backend is used after all
+hardware_import_error = None
+try:
+    digitalio = timed_import("digitalio")
+    busio = timed_import("busio")
+    board = timed_import("board")
+    Adafruit_SSD1680 = timed_import("adafruit_epd.ssd1680").Adafruit_SSD1680
+    Adafruit_EPD = timed_import("adafruit_epd.epd").Adafruit_EPD
+except (ImportError, NotImplementedError) as err:
+    #Not on the Pi, only --backend virtual works. The virtual display stands in
+    #for the driver classes, so the rest of this file can be used as is.
+    hardware_import_error = err
+    digitalio = busio = board = None
+    Adafruit_SSD1680 = Adafruit_EPD = timed_import("virtualHardware").VirtualSSD1680
+Image = timed_import("PIL.Image")
+ImageDraw = timed_import("PIL.ImageDraw")
+ImageFont = timed_import("PIL.ImageFont")
+import os
 from os import path
-from numpy import random
 import argparse
-from urllib.request import urlopen
-import re
-from datetime import datetime
-import drawWeather
-import matplotlib.pyplot as plt
+import asyncio
+import hashlib
+import json
+import metrics
+import supervisor
+import queue
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 
 #The job of this class is to keep track of button presses and give signal
-#when a decision of button presses has been made.
-class ListenButtons:
-    def __init__(self):
-        self.time_at_press = None
-        self.last_state1 = False
-        self.last_state2 = False
-        self.n1 = 0
-        self.n2 = 0
-        self.reset = False
-        self.resetting_time = 2
-
-
-    def set_resetting_time(self,new_time):
-        self.resetting_time=new_time
-        return
-
-    #Return true if buttons were pressed and a decision of press has been made.
-    #Return false if no buttons pressed, or the listening time of button presses
-    #has not yet ended.
-    def check_button_state(self,button1,button2):
-        #We want to do reset only in the next loop as otherwise we lose the
-        #number of presses.
-        if self.reset:
-            self.n1=0
-            self.n2=0
-            self.time_at_press = None
-            self.reset=False
+#when a decision of button presses has been made. Every press is timestamped
+#when it happens and put in a queue of edges, a decoder thread debounces them
+#and, when no press has come for resetting_time, puts the counts (n1, n2) in a
+#queue of gestures. Contact bounce gives several edges for one press and more
+#when the button is let go, so a press is counted only when the edges of a
+#button have been quiet for debounce seconds and the button is still down.
+#wait() blocks the main loop until the next gesture or a deadline, so nothing
+#has to be polled and short presses are not lost.
+#The edges come from one of the backends:
+#  "gpio"  edge interrupts of RPi.GPIO on the board pins of the buttons
+#  "poll"  a thread reading the digitalio buttons every poll_interval
+#          seconds, for when RPi.GPIO is not available
+#  "mock"  no source, the presses are given with press() and release(),
+#          for testing
+#  "auto"  gpio if RPi.GPIO can be imported, otherwise poll
+class ButtonEvents:
+    def __init__(self,l_buttons,l_pins,l_backend="auto",l_resetting_time=0.8,l_debounce=0.05,l_poll_interval=0.05):
+        self.buttons=l_buttons
+        self.pins=l_pins
+        self.resetting_time=l_resetting_time
+        self.debounce=l_debounce
+        self.poll_interval=l_poll_interval
+        #The buttons that are down, for the mock backend, and the ones the poll
+        #thread has seen down since their last press was decoded
+        self.mock_down=set()
+        self.seen_down=set()
+        self.edges=queue.Queue()
+        self.gestures=queue.Queue()
+        if l_backend=="auto":
+            try:
+                timed_import("RPi.GPIO")
+                l_backend="gpio"
+            except ImportError:
+                l_backend="poll"
+        self.backend=l_backend
+        if self.backend=="gpio":
+            self._start_gpio()
+        elif self.backend=="poll":
+            threading.Thread(target=self._poll_loop, daemon=True).start()
+        elif self.backend!="mock":
+            raise ValueError("Unknown button backend: "+self.backend)
+        threading.Thread(target=self._decode_loop, daemon=True).start()
+
+    #Records an edge of button number 1 or 2, at the given time.monotonic().
+    #With the mock backend the button is down after press() and up after
+    #release(), the edge of release() is like the bounce of a real button.
+    def press(self,button,at=None):
+        if self.backend=="mock":
+            self.mock_down.add(button)
+        self.edges.put((button, at if at is not None else time.monotonic()))
+
+    def release(self,button,at=None):
+        self.mock_down.discard(button)
+        self.edges.put((button, at if at is not None else time.monotonic()))
+
+    def _is_down(self,button):
+        if self.backend=="gpio":
+            return self.GPIO.input(self.channels[button])==0
+        if self.backend=="poll":
+            #A poll is too rare to hit the bounce, but a short press may be
+            #over by now
+            down = button in self.seen_down
+            self.seen_down.discard(button)
+            return down
+        return button in self.mock_down
+
+    #Gives the next gesture (n1, n2), or None if timeout seconds passed.
+    #timeout=None waits forever.
+    def wait(self,timeout=None):
+        try:
+            return self.gestures.get(timeout=timeout if timeout is None else max(timeout,0))
+        except queue.Empty:
+            return None
+
+    #Forgets the presses so far, e.g. the ones made while playing the game
+    def clear(self):
+        self.edges.put(None)
+        while True:
+            try:
+                self.gestures.get_nowait()
+            except queue.Empty:
+                return
+
+    def _start_gpio(self):
+        GPIO = self.GPIO = timed_import("RPi.GPIO")
+        GPIO.setmode(GPIO.BCM)
+        self.channels = {}
+        for (number, pin) in enumerate(self.pins, 1):
+            #The board pins of Blinka know their BCM number
+            channel = self.channels[number] = getattr(pin, "id", pin)
+            GPIO.setup(channel, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            #The buttons pull the pin low when pressed
+            GPIO.add_event_detect(channel, GPIO.FALLING,
+                                  callback=lambda channel, number=number: self.press(number))
+
+    def _poll_loop(self):
         #button.value gives False if pressed
-        button1_was_pressed = not button1
-        button2_was_pressed = not button2
-        #We do not want a long press to count as multiple presses
-        if self.last_state1!=button1_was_pressed and button1_was_pressed:
-            #if self.time_at_press:
-            #    print("Press interval:",time.monotonic()-self.time_at_press,"resetting time:",self.resetting_time)
-            self.time_at_press = time.monotonic()
-            self.n1+=1
-        if self.last_state2!=button2_was_pressed and button2_was_pressed:
-            self.time_at_press = time.monotonic()
-            self.n2+=1
-        self.last_state1 = button1_was_pressed
-        self.last_state2 = button2_was_pressed
-        if self.time_at_press and time.monotonic()-self.time_at_press > self.resetting_time:
-            self.reset=True
-            return True
-        return False
+        last_pressed = [False]*len(self.buttons)
+        while True:
+            for (i, button) in enumerate(self.buttons):
+                pressed = not button.value
+                if pressed:
+                    self.seen_down.add(i+1)
+                if pressed and not last_pressed[i]:
+                    self.press(i+1)
+                last_pressed[i] = pressed
+            time.sleep(self.poll_interval)
+
+    def _decode_loop(self):
+        counts = [0]*(len(self.buttons)+1)
+        #The time of the last edge of each button that has not settled yet
+        last_edge = [None]*(len(self.buttons)+1)
+        time_at_press = None
+        while True:
+            deadlines = [at+self.debounce for at in last_edge if at is not None]
+            if time_at_press is not None:
+                deadlines.append(time_at_press+self.resetting_time)
+            timeout = max(min(deadlines)-time.monotonic(), 0) if deadlines else None
+            try:
+                edge = self.edges.get(timeout=timeout)
+            except queue.Empty:
+                edge = ()
+            if edge is None:
+                counts = [0]*len(counts)
+                last_edge = [None]*len(last_edge)
+                time_at_press = None
+                continue
+            if edge:
+                #Every edge starts the quiet time of its button again
+                (button, at) = edge
+                last_edge[button] = at
+            now = time.monotonic()
+            for button in range(1, len(last_edge)):
+                if last_edge[button] is not None and now >= last_edge[button]+self.debounce:
+                    last_edge[button] = None
+                    #The edges of letting go end with the button up
+                    if self._is_down(button):
+                        counts[button]+=1
+                        time_at_press = now
+            if (time_at_press is not None and now >= time_at_press+self.resetting_time
+                    and not any(at is not None for at in last_edge)):
+                self.gestures.put(tuple(counts[1:]))
+                counts = [0]*len(counts)
+                time_at_press = None
+
+
+#Least recently used cache of rendered images. The keys are hashes of whatever
+#the image was made from, so the same content is never rendered twice. The
+#memory is bounded by max_bytes. If a folder is given, the images are also
+#saved there as PNG files, at most max_files of them, so they survive restarts.
+class ImageCache:
+    def __init__(self,l_max_bytes=2*1024*1024,l_folder=None,l_max_files=256):
+        self.max_bytes=l_max_bytes
+        self.folder=l_folder
+        self.max_files=l_max_files
+        self.images=OrderedDict()
+        self.used_bytes=0
+        self.hits=0
+        self.misses=0
+        if self.folder:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+            except OSError as err:
+                print("Could not make the image cache folder, the images are kept in memory only:", err)
+                self.folder=None
+
+    #Makes a cache key from anything that can be printed with repr
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def _file_path(self,key):
+        return path.join(self.folder, key+".png")
+
+    def _remember(self,key,image):
+        self.images[key]=image
+        self.used_bytes+=image.size[0]*image.size[1]*len(image.getbands())
+        while self.used_bytes>self.max_bytes and len(self.images)>1:
+            (old_key, old_image) = self.images.popitem(last=False)
+            self.used_bytes-=old_image.size[0]*old_image.size[1]*len(old_image.getbands())
+
+    #Gives the image of the key or None if it has not been cached
+    def get(self,key):
+        if key in self.images:
+            self.images.move_to_end(key)
+            self.hits+=1
+            return self.images[key]
+        if self.folder and path.exists(self._file_path(key)):
+            try:
+                with Image.open(self._file_path(key)) as disk_img:
+                    image = disk_img.convert("RGB")
+                self._remember(key,image)
+                self.hits+=1
+                return image
+            except OSError as err:
+                print("Could not read cached image:", err)
+        self.misses+=1
+        return None
+
+    def put(self,key,image):
+        #The image might share memory with its renderer, e.g. a matplotlib canvas
+        image = image.convert("RGB")
+        self._remember(key,image)
+        if self.folder:
+            try:
+                image.save(self._file_path(key))
+                self._prune_folder()
+            except OSError as err:
+                print("Could not save cached image:", err)
+        return image
+
+    #Gives the cached image or makes it with render() and caches it
+    def get_or_render(self,key,render):
+        image = self.get(key)
+        if image is None:
+            image = self.put(key,render())
+        return image
+
+    def _prune_folder(self):
+        files = [entry for entry in os.scandir(self.folder) if entry.name.endswith(".png")]
+        if len(files)<=self.max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files)-self.max_files]:
+            os.remove(entry.path)
+
+
+#Index of the black and white ('bw' in the name) pictures of the picture folder.
+#The index is saved in a manifest with the size and mtime of every picture, so
+#a restart does not need to go through the whole folder again. The manifest is
+#kept in a folder of its own under ~/.cache, as the picture folder may be read
+#only, and without one the index is only kept in memory. refresh() only lists
+#the folders whose mtime has changed and stats the known pictures, so new
+#pictures show up without a restart. If the folder cannot be read or has no
+#pictures left, the old index is kept. Random pictures are dealt from a
+#shuffled deck, so every picture is shown once before any is shown again.
+#The pictures are fitted to the frame from the originals, and the fitted ones
+#are kept in the picture cache of WeatherImageManipulations, which is saved in
+#the library folder too.
+class PictureLibrary:
+    manifest_version = 3
+
+    def __init__(self,l_folder,l_defpic,l_library_folder=None,l_on_progress=None):
+        self.folder=l_folder
+        self.defpic=l_defpic
+        self.library_folder=l_library_folder or path.join(
+            path.expanduser("~"), ".cache", "e-display", "library",
+            hashlib.sha1(path.abspath(l_folder).encode("utf-8")).hexdigest()[:12])
+        #Called every save_interval seconds while a big folder is indexed,
+        #so that a supervisor can see we are not stuck
+        self.on_progress=l_on_progress
+        self.save_interval=5
+        self.dirs={}
+        self.entries={}
+        self.pictures=[]
+        self.deck=[]
+        self.last_random=None
+        try:
+            os.makedirs(self.library_folder, exist_ok=True)
+        except OSError as err:
+            print("Could not make the picture library folder, the index is not saved:", err)
+            self.library_folder=None
+        self.manifest_file=path.join(self.library_folder, "manifest.json") if self.library_folder else None
+        try:
+            with open(self.manifest_file, 'r', encoding="utf-8") as fil:
+                manifest = json.load(fil)
+            if manifest["version"]==self.manifest_version:
+                self.dirs=manifest["dirs"]
+                self.entries=manifest["pictures"]
+        except (OSError, TypeError, ValueError, KeyError):
+            pass
+        self.refresh(force_save=True)
+
+    def _make_entry(self,pic_path,mtime):
+        #Only the header is read for the size
+        with Image.open(pic_path) as pic:
+            (width, height) = pic.size
+        return {"width": width,
+                "height": height,
+                "mtime": mtime}
+
+    #Updates the index. Returns True if some picture was added, changed or removed.
+    def refresh(self,force_save=False):
+        changed = False
+        seen_dirs = {}
+        stack = [self.folder]
+        last_save = time.monotonic()
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            known = self.dirs.get(dirpath)
+            if known and known["mtime"]==mtime:
+                subdirs = known["subdirs"]
+                names = known["pictures"]
+            else:
+                subdirs = []
+                names = []
+                try:
+                    for entry in os.scandir(dirpath):
+                        #Hidden folders, like the .library of older versions, are skipped
+                        if entry.is_dir() and not entry.name.startswith("."):
+                            subdirs.append(entry.path)
+                        elif entry.is_file() and "bw" in entry.name:
+                            names.append(entry.name)
+                except OSError as err:
+                    print("Could not list the picture folder:", err)
+                    continue
+            seen_dirs[dirpath] = {"mtime": mtime, "subdirs": subdirs, "pictures": names}
+            stack.extend(subdirs)
+            for name in names:
+                pic_path = path.join(dirpath, name)
+                try:
+                    pic_mtime = os.stat(pic_path).st_mtime
+                    if pic_path not in self.entries or self.entries[pic_path]["mtime"]!=pic_mtime:
+                        self.entries[pic_path] = self._make_entry(pic_path, pic_mtime)
+                        changed = True
+                except OSError as err:
+                    print("Could not add picture to the library:", err)
+                if time.monotonic()-last_save > self.save_interval:
+                    #The pictures so far are saved, so an interrupted first
+                    #index of a big folder goes on from here the next time.
+                    #The folders are not, so they are all listed again.
+                    if changed:
+                        self._save()
+                    if self.on_progress:
+                        self.on_progress()
+                    last_save = time.monotonic()
+
+        listed = set(path.join(dirpath, name) for (dirpath, known) in seen_dirs.items()
+                     for name in known["pictures"])
+        if not listed and self.pictures:
+            print("No pictures found in {}, keeping the old ones".format(self.folder))
+            return False
+        for pic_path in list(self.entries):
+            if pic_path not in listed:
+                del self.entries[pic_path]
+                changed = True
+        self.dirs = seen_dirs
+
+        if changed or force_save:
+            #Nice to have the files in alphabetical order
+            self.pictures = sorted(self.entries, key=lambda pic_path: (path.dirname(pic_path), path.basename(pic_path)))
+            self.deck = []
+            self._save()
+        return changed
+
+    def _save(self):
+        if not self.manifest_file:
+            return
+        tmp = self.manifest_file+".tmp"
+        try:
+            with open(tmp, 'w', encoding="utf-8") as fil:
+                json.dump({"version": self.manifest_version,
+                           "dirs": self.dirs,
+                           "pictures": self.entries}, fil)
+            os.replace(tmp, self.manifest_file)
+        except OSError as err:
+            print("Could not save the picture library:", err)
+
+    def __len__(self):
+        return len(self.pictures)
+
+    #The picture given as default, or the first one. "yuuka" picture is the default one.
+    def default_picture(self):
+        defaults = [pic_path for pic_path in self.pictures if self.defpic in path.basename(pic_path)]
+        if defaults:
+            return defaults[-1]
+        return self.pictures[0]
+
+    #Deals the next picture from the shuffled deck
+    def next_random(self):
+        if not self.deck:
+            self.deck = list(self.pictures)
+            timed_import("numpy.random").shuffle(self.deck)
+            #Do not show the same picture twice in a row when a new deck starts
+            if len(self.deck)>1 and self.deck[-1]==self.last_random:
+                (self.deck[0], self.deck[-1]) = (self.deck[-1], self.deck[0])
+        self.last_random = self.deck.pop()
+        return self.last_random
 
 
 #This function is used to create the Image object shown in the screen
@@ -82,8 +506,12 @@ class WeatherImageManipulations:
         self.width=l_width
         self.height=l_height
         self.show_in_out=1
-        self.skip_lines=0
         self.show_days_graph=1
+        drawWeather = timed_import("drawWeather")
+        self.follower=drawWeather.WeatherFollower(self.filename_weather, self.show_days_graph)
+        self.plot_backend="matplotlib"
+        self.plot_cache=ImageCache()
+        self.pic_cache=ImageCache(l_max_bytes=4*1024*1024)
         self.boldSize=26
         self.bold_font = ImageFont.truetype(
             "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", self.boldSize
@@ -97,16 +525,38 @@ class WeatherImageManipulations:
             "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", self.smollerSize
         )
 
+    #"matplotlib" or "pil"
+    def set_plot_backend(self,new_backend):
+        self.plot_backend=new_backend
+
+    def set_plot_cache(self,new_cache):
+        self.plot_cache=new_cache
+
+    def set_pic_cache(self,new_cache):
+        self.pic_cache=new_cache
+
+    #The settings changed with the buttons, for the state saved between runs
+    def settings(self):
+        return {"show_in_out": self.show_in_out,
+                "show_days_graph": self.show_days_graph}
+
+    def restore_settings(self,settings):
+        self.show_in_out=settings.get("show_in_out", self.show_in_out)
+        self.show_days_graph=settings.get("show_days_graph", self.show_days_graph)
+        self.follower.set_days(self.show_days_graph)
+
     def switch_in_out(self):
         if self.show_in_out==1:
             self.show_in_out=2
         else:
             self.show_in_out=1
 
-    def set_skip_lines(self,new_skip):
-        self.skip_lines=new_skip
+    #If reread_data is False, the weather data already in memory is used.
+    def create_weather_image(self, filename_pic, flip_pic=True, reread_data=True):
+        with metrics.stage("create_weather_image"):
+            return self._draw_weather_image(filename_pic, flip_pic, reread_data)
 
-    def create_weather_image(self, filename_pic, flip_pic=True):
+    def _draw_weather_image(self, filename_pic, flip_pic, reread_data):
         #Define fonts
 
         if self.show_in_out==1:
@@ -127,13 +577,13 @@ class WeatherImageManipulations:
         yLab = []
         #timing1 = time.perf_counter()
         try:
-            (meas_time,temp,humidi,pressure,xLab,yLab,lines) = drawWeather.get_weather_data(self.filename_weather,
-                                                               deviceNow, self.show_days_graph, self.skip_lines)
-            #We start by not skipping lines, but after that
-            #we know how many we need to skip in order to show
-            #all of the data we need. This will speed up the
-            #reading of the file significantly (~one magnitude)
-            self.set_skip_lines(lines-self.show_days_graph*24*60/5) #Next iteration we want to minimize the reading of the file.
+            #numpy is imported by drawWeather, but this way its import time is reported
+            timed_import("numpy")
+            #The follower remembers where it stopped reading, so only the
+            #rows readRuuvi.py has appended since the last refresh are parsed.
+            #It keeps all devices, so switching between them needs no reading.
+            with metrics.stage("get_weather_data"):
+                (meas_time,temp,humidi,pressure,xLab,yLab,lines) = self.follower.get_weather_data(deviceNow, reread_data)
             leng = len(meas_time)
             if leng==0:
                 print("No events to show")
@@ -170,50 +620,47 @@ class WeatherImageManipulations:
         if bbRight2>bbRight:
             bbRight=bbRight2
 
-        plt_img=make_plot_image(meas_time,temp,bbRight,self.height-bbBottom-1)
-        image.paste(plt_img, box=(xCoord,bbBottom+1), mask=None)
-
-        with Image.open(filename_pic).convert("RGB") as paste_img:
-            #Can I get automatic contrast/brightness enhancement working?
-            #enhance_color = ImageEnhance.Color(paste_img)
-            #paste_img = enhance_color.enhance(0.0)
-            #enhance_contrast = ImageEnhance.Contrast(paste_img)
-            #paste_img = enhance_contrast.enhance(0.5)
-            #enhance_brightness = ImageEnhance.Brightness(paste_img)
-            #paste_img = enhance_brightness.enhance(0.95)
-
-            resize_lim_h = self.height #90
-            resize_lim_w = self.width-bbRight
-            resize_x1 = paste_img.size[0]
-            resize_y1 = paste_img.size[1]
-            resize_x2 = paste_img.size[0]
-            resize_y2 = paste_img.size[1]
-            #Test which restriction (x or y) is creating the smaller image and scale with that
-            if resize_y1>resize_lim_h:
-                resize_x1 = round(paste_img.size[0]*resize_lim_h/paste_img.size[1])
-                resize_y1 = resize_lim_h
-            if resize_x2>resize_lim_w:
-                resize_x2 = resize_lim_w
-                resize_y2 = round(paste_img.size[1]*resize_lim_w/paste_img.size[0])
-            if resize_y1<resize_y2:
-                paste_img=paste_img.resize((resize_x1, resize_y1),resample=Image.LANCZOS, reducing_gap=3.0)
+        #The plot only changes when there is new data, so the same data
+        #window gives the same plot as last time without plotting.
+        plot_width = bbRight
+        plot_height = self.height-bbBottom-1
+        plot_key = ImageCache.make_key(deviceNow, str(meas_time[leng-1]), leng,
+                                       plot_width, plot_height, self.plot_backend)
+        with metrics.stage("plot"):
+            if self.plot_backend=="pil":
+                plt_img=self.plot_cache.get_or_render(plot_key,
+                            lambda: make_plot_image_pil(meas_time,temp,plot_width,plot_height))
             else:
-                paste_img=paste_img.resize((resize_x2, resize_y2),resample=Image.LANCZOS, reducing_gap=3.0)
+                plt_img=self.plot_cache.get_or_render(plot_key,
+                            lambda: make_plot_image(meas_time,temp,plot_width,plot_height))
+        image.paste(plt_img, box=(xCoord,bbBottom+1), mask=None)
 
-            if flip_pic:
-                paste_img=paste_img.transpose(method=Image.FLIP_LEFT_RIGHT)
+        #The picture is the same every time for the same file and space, so
+        #it is decoded and resized only once.
+        resize_lim_h = self.height #90
+        resize_lim_w = self.width-bbRight
+        try:
+            pic_key = ImageCache.make_key(filename_pic, os.stat(filename_pic).st_mtime,
+                                          resize_lim_w, resize_lim_h, flip_pic)
+            with metrics.stage("picture"):
+                paste_img = self.pic_cache.get_or_render(pic_key,
+                                lambda: fit_picture(filename_pic, resize_lim_w, resize_lim_h, flip_pic))
+        except OSError as err:
+            #The picture was removed after the library was refreshed
+            print("Could not read the picture, showing the weather only:", err)
+            return image
 
-            #If the image has space, let's center it in the available space.
-            #Otherwise it will be tightly fitted into the space.
-            if paste_img.size[0]!=resize_lim_w:
-                paste_l_pos = round((self.width+bbRight)/2 - paste_img.size[0]/2)
-            else:
-                paste_l_pos = self.width-paste_img.size[0]
-            if paste_img.size[1]!=resize_lim_h:
-                paste_t_pos = round(self.height/2 - paste_img.size[1]/2)
-            else:
-                paste_t_pos = self.height-paste_img.size[1]
-            image.paste(paste_img, box=(paste_l_pos,paste_t_pos), mask=None)
+        #If the image has space, let's center it in the available space.
+        #Otherwise it will be tightly fitted into the space.
+        if paste_img.size[0]!=resize_lim_w:
+            paste_l_pos = round((self.width+bbRight)/2 - paste_img.size[0]/2)
+        else:
+            paste_l_pos = self.width-paste_img.size[0]
+        if paste_img.size[1]!=resize_lim_h:
+            paste_t_pos = round(self.height/2 - paste_img.size[1]/2)
+        else:
+            paste_t_pos = self.height-paste_img.size[1]
+        image.paste(paste_img, box=(paste_l_pos,paste_t_pos), mask=None)
 
         #draw.line((bbRight,0,bbRight,self.height), fill=BLACK,)
         #print(self.width-bbRight)
@@ -221,12 +668,15 @@ class WeatherImageManipulations:
         return image
 
     #This function is used to create the Image object shown in the screen
-    def create_sun_image(self,country_name, city_name):
+    #sun_info is the result of find_sun_info, if it has already been fetched
+    def create_sun_image(self,country_name, city_name, sun_info=None):
         #Define fonts
         image = Image.new("RGB", (self.width, self.height), color=WHITE)
         draw = ImageDraw.Draw(image)
 
-        (daylen, sunrise, sundown) = find_sun_info(country_name,city_name)
+        if sun_info is None:
+            sun_info = find_sun_info(country_name,city_name)
+        (daylen, sunrise, sundown) = sun_info
         daylen_split = daylen.split(':')
 
         #In case of nightless night or sunless day:
@@ -303,104 +753,271 @@ class WeatherImageManipulations:
         return image
 
 
-    #With this one can test how fast the screen updates. Can choose also whether you
-    #print at the screen or to the command line.
-    def fps_test(self,display,b_draw_text):
+    #Frame n of an fps_test scenario, or None if the scenario cannot be run
+    def _fps_test_frame(self, scenario, n, filename_pic):
+        if scenario=="weather":
+            #Empty caches, so every frame is plotted and the picture fitted
+            #again instead of timing cache hits
+            (plot_cache, pic_cache) = (self.plot_cache, self.pic_cache)
+            (self.plot_cache, self.pic_cache) = (ImageCache(), ImageCache(l_max_bytes=4*1024*1024))
+            try:
+                return self.create_weather_image(filename_pic)
+            finally:
+                (self.plot_cache, self.pic_cache) = (plot_cache, pic_cache)
+        image = Image.new("RGB", (self.width, self.height), color=WHITE)
+        draw = ImageDraw.Draw(image)
+        if scenario=="blank":
+            #Every other frame black so that each refresh changes the panel
+            if n%2:
+                draw.rectangle((0, 0, self.width, self.height), fill=BLACK)
+        elif scenario=="text":
+            for row in range(4):
+                draw.text((3, 3+row*(self.smolSize+6)), "Frame {} row {}".format(n, row),
+                          font=self.smol_font, fill=BLACK)
+        elif scenario=="partial":
+            #Only a small counter in the corner changes
+            draw.text((3, 3), "{:04d}".format(n), font=self.smol_font, fill=BLACK)
+        return image
+
+    #With this one can test how fast the screen updates. Runs frames refreshes
+    #of each scenario straight on the display driver and times the stages of
+    #each separately:
+    #  render    drawing the frame with PIL (and the plot for "weather")
+    #  pack      packing the frame into the framebuffers of the driver
+    #  transfer  the rest of display(): power up, SPI transfer, power down
+    #  busy      waiting for the busy pin while the panel refreshes
+    #The scenarios are a blank frame ("blank"), text only ("text"), the full
+    #weather frame without the plot and picture caches ("weather"), and a
+    #partial refresh where only a corner changes ("partial", needs a display
+    #with partial_display, and its first frame is a full refresh). Gives
+    #{scenario: {stage: summary}}, see metrics.summarize, and prints a table.
+    def fps_test(self, display, frames=10, scenarios=("blank", "text", "weather", "partial"), filename_pic=None):
+        #busy_wait is timed by wrapping it for the time of the test
+        busy_time = [0.0]
+        driver_busy_wait = display.busy_wait
+        def timed_busy_wait():
+            timing1 = time.perf_counter()
+            driver_busy_wait()
+            busy_time[0] += time.perf_counter()-timing1
+        display.busy_wait = timed_busy_wait
+
+        results = {}
         try:
-            time_delta = 0.0
-            while True:
-                timing1 = time.perf_counter()
-                #print("Timing:",timing2-timing1)
-                image = Image.new("RGB", (self.width, self.height), color=WHITE)
-                if b_draw_text:
-                    draw = ImageDraw.Draw(image)
-                    printText = "Time delta: {:0.3f}".format(time_delta)
-                    (bbLeft, bbTop, bbRight, bbBottom) = draw.textbbox((0,0), printText, font=self.smol_font)
-                    draw.text((self.width/2.0-bbRight/2.0,self.height/2.0-bbBottom/2.0), printText, font=self.smol_font, fill=BLACK,)
-                    show_image(display,image)
-                else:
-                    #print("FPS: {:0.3f}, Delta: {:0.3f}".format(1.0/time_delta,time_delta))
-                    print("Delta: {:0.3f}".format(time_delta))
-                    show_image(display,image)
-                timing2 = time.perf_counter()
-                time_delta = timing2-timing1
-                time.sleep(0.05)
+            for scenario in scenarios:
+                if scenario=="partial" and not hasattr(display, "partial_display"):
+                    print("Skipping the partial scenario, the display has no partial refresh")
+                    continue
+                if scenario=="weather" and not filename_pic:
+                    print("Skipping the weather scenario, there is no picture")
+                    continue
+                times = {"render": [], "pack": [], "transfer": [], "busy": []}
+                previous_black = None
+                for n in range(frames):
+                    timing1 = time.perf_counter()
+                    image = self._fps_test_frame(scenario, n, filename_pic)
+                    timing2 = time.perf_counter()
+                    if not pack_image(display, image):
+                        display.fill(Adafruit_EPD.WHITE)
+                        display.image(image)
+                    timing3 = time.perf_counter()
+                    busy_time[0] = 0.0
+                    if scenario=="partial" and previous_black is not None:
+                        display.partial_display(previous_black, dirty_window(display, previous_black))
+                    else:
+                        display.display()
+                    timing4 = time.perf_counter()
+                    if hasattr(display, "_buffer1"):
+                        previous_black = bytes(display._buffer1)
+                    times["render"].append(timing2-timing1)
+                    times["pack"].append(timing3-timing2)
+                    times["transfer"].append(timing4-timing3-busy_time[0])
+                    times["busy"].append(busy_time[0])
+                results[scenario] = {stage: metrics.summarize(stage_times)
+                                     for (stage, stage_times) in times.items()}
+                print("{} ({} frames)".format(scenario, frames))
+                for (stage, summary) in results[scenario].items():
+                    print("  {:9s} min {:9.1f} ms  median {:9.1f} ms  p95 {:9.1f} ms".format(
+                        stage, summary["min"]*1000, summary["median"]*1000, summary["p95"]*1000))
         except KeyboardInterrupt:
-            print("\nFPS test interrupted, exiting")
-        return
+            print("\nFPS test interrupted")
+        finally:
+            display.busy_wait = driver_busy_wait
+        return results
+
+
+#The patterns of the timeanddate.com sun page, a row of the table per day.
+#They are compiled when the first page is parsed, so they cost nothing with
+#--sunsource local.
+_sun_patterns = {}
+def _sun_pattern(name):
+    if not _sun_patterns:
+        re = timed_import("re")
+        _sun_patterns.update({
+            "day": re.compile("data-day=(\\d+).*?</tr>", re.IGNORECASE),
+            "nightless": re.compile("Up all day", re.IGNORECASE),
+            "sunless": re.compile("Down all day", re.IGNORECASE),
+            "daylen": re.compile("<td class=\"c tr sep-l\".*?>.*?</td.*?>", re.IGNORECASE),
+            "sunrise": re.compile("<td class=\"c sep\".*?>.*?</td.*?>", re.IGNORECASE),
+            "sundown": re.compile("<td class=\"sep c\".*?>.*?</td.*?>", re.IGNORECASE),
+            "extra_info": re.compile("span.*?span"),
+            "tag": re.compile("<.*?>"),
+            "whitespace": re.compile("\\s*?")})
+    return _sun_patterns[name]
+
+#Gives (length_of_day, sunrise, sundown) of one day row of the sun page
+def parse_sun_day(date_result):
+    #Let's first check if there is sun up or down at all.
+    if _sun_pattern("nightless").search(date_result):
+        return ("nightless","nightless","nightless")
+    if _sun_pattern("sunless").search(date_result):
+        return ("sunless","sunless","sunless")
+
+    match_results = _sun_pattern("daylen").findall(date_result)
+    length_of_day = _sun_pattern("tag").sub("", match_results[0]) #Remove < ... >
+    length_of_day = _sun_pattern("whitespace").sub("", length_of_day) #Remove whitespace
+
+    match_results = _sun_pattern("sunrise").findall(date_result)
+    sunrise = _sun_pattern("extra_info").sub("", match_results[0]) #Remove extra info
+    sunrise = _sun_pattern("tag").sub("", sunrise)
+    sunrise = _sun_pattern("whitespace").sub("", sunrise)
+
+    match_results = _sun_pattern("sundown").findall(date_result)
+    sundown = _sun_pattern("extra_info").sub("", match_results[0])
+    sundown = _sun_pattern("tag").sub("", sundown)
+    sundown = _sun_pattern("whitespace").sub("", sundown)
+
+    #The timeanddate.com will return only '-' in case sundown
+    #happens exactly at midnight.
+    if sundown=='-':
+        sundown='00.00'
+
+    return (length_of_day, sunrise, sundown)
+
+#Gives the sun info of every day of a month, {day: (length_of_day, sunrise, sundown)}
+#with the days as strings, parsed from one timeanddate.com page.
+def parse_sun_month(html):
+    month_table = {}
+    for match in _sun_pattern("day").finditer(html):
+        if match.group(1) in month_table:
+            continue
+        try:
+            month_table[match.group(1)] = parse_sun_day(match.group(0))
+        except IndexError:
+            #Not a full row of the table, the day is left out
+            continue
+    return month_table
+
+#The sun page of timeanddate.com has the whole month, so it is fetched once per
+#month and parsed into a table of days. The tables are kept in memory and, if
+#a folder is given, as JSON files there, so the sun view is instant also after
+#a restart. A file that cannot be read is fetched again, and if it cannot be
+#written the table is only kept in memory. Near the end of the month the next
+#month is fetched in the background.
+class SunInfoCache:
+    def __init__(self,l_folder=None,l_timeout=10,l_prefetch_days=3):
+        self.folder=l_folder
+        self.timeout=l_timeout
+        self.prefetch_days=l_prefetch_days
+        self.months={}
+        self.lock=threading.Lock()
+        if self.folder:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+            except OSError as err:
+                print("Could not make the sun cache folder, the months are kept in memory only:", err)
+                self.folder=None
+
+    def _file(self,key):
+        return path.join(self.folder, "{}_{}_{}_{:02d}.json".format(*key))
+
+    #Gives the table of the month, or None if it could not be fetched
+    def month(self,country_name,city_name,year,month):
+        key = (country_name, city_name, year, month)
+        with self.lock:
+            if key in self.months:
+                return self.months[key]
+            if self.folder and path.isfile(self._file(key)):
+                try:
+                    with open(self._file(key)) as fil:
+                        self.months[key] = json.load(fil)
+                    return self.months[key]
+                except (OSError, ValueError) as err:
+                    print("Could not read the cached sun month, fetching it again:", err)
+        month_table = self._fetch(key)
+        if not month_table:
+            return None
+        with self.lock:
+            self.months[key] = month_table
+            if self.folder:
+                try:
+                    with open(self._file(key)+".tmp", "w") as fil:
+                        json.dump(month_table, fil)
+                    os.replace(self._file(key)+".tmp", self._file(key))
+                except OSError as err:
+                    print("Could not save the sun month:", err)
+        return month_table
+
+    def _fetch(self,key):
+        urlopen = timed_import("urllib.request").urlopen
+        (country_name, city_name, year, month) = key
+        url = "https://www.timeanddate.com/sun/{}/{}?month={}&year={}".format(country_name,city_name,str(month),str(year))
+        try:
+            with urlopen(url, timeout=self.timeout) as page:
+                return parse_sun_month(page.read().decode("utf-8"))
+        except OSError as er:
+            print("Error:",er,url)
+            return None
 
+    #Fetches the month in a background thread, unless it is already cached
+    def prefetch(self,country_name,city_name,year,month):
+        if (country_name, city_name, year, month) not in self.months:
+            threading.Thread(target=self.month, args=(country_name, city_name, year, month),
+                             daemon=True).start()
+
+    def sun_info(self,country_name,city_name,day=None):
+        if day is None:
+            day = datetime.now().date()
+        if (day+timedelta(days=self.prefetch_days)).month!=day.month:
+            next_month = day.replace(day=1)+timedelta(days=32)
+            self.prefetch(country_name, city_name, next_month.year, next_month.month)
+        month_table = self.month(country_name, city_name, day.year, day.month)
+        if not month_table:
+            return ("","","")
+        return tuple(month_table.get(str(day.day), ("","","")))
+
+_sun_info_cache = SunInfoCache()
 
 #Finds and returns the length of day, sunrise, and sundown for a given city
 #either from the timeanddate.com wep page or by argument. If there is a nightless
 #night, returns ("nightless","nightless","nightless"), or if there is a sunless
 #day, returns ("sunless","sunless","sunless"). In case of failure returns ("","","")
+#The month pages are kept in cache, by default only in memory.
 #
 #Some parts of this function and the general inspiration from this repository:
 #https://github.com/I-pot/CurrencyFluctuations
-def find_sun_info(country_name, city_name, pre_year=-1, pre_month=-1, pre_date=-1):
+def find_sun_info(country_name, city_name, pre_year=-1, pre_month=-1, pre_date=-1, cache=None):
     if pre_year==-1 and pre_month==-1 and pre_date==-1:
-        currTime = str(datetime.now().date()).split('-')
-        strYear = currTime[0]
-        intMonth = int(currTime[1])
-        intDate  = int(currTime[2])
+        day = None
     else:
-        strYear = str(pre_year)
-        intMonth = pre_month
-        intDate = pre_date
-    url = "https://www.timeanddate.com/sun/{}/{}?month={}&year={}".format(country_name,city_name,str(intMonth),strYear)
-    try:
-        with urlopen(url) as page:
-            html_bytes = page.read()
-            html = html_bytes.decode("utf-8")
-            date_pattern = "data-day={}.*?</tr>".format(intDate,intDate+1)
-            date_results = re.findall(date_pattern, html, re.IGNORECASE)
-
-            if len(date_results)==0:
-                return ("","","")
-            date_result = date_results[0]
-
-            #Let's first check if there is sun up or down at all.
-            nightless_night_pattern = "Up all day"
-            match_results = re.findall(nightless_night_pattern, date_result, re.IGNORECASE)
-            if len(match_results)>0:
-                return ("nightless","nightless","nightless")
-            sunless_day_pattern = "Down all day"
-            match_results = re.findall(sunless_day_pattern, date_result, re.IGNORECASE)
-            if len(match_results)>0:
-                return ("sunless","sunless","sunless")
-
-            time_pattern = "<td class=\"c tr sep-l\".*?>.*?</td.*?>"
-            match_results = re.findall(time_pattern, date_result, re.IGNORECASE)
-            length_of_day = re.sub("<.*?>", "", match_results[0]) #Remove < ... >
-            length_of_day = re.sub("\s*?", "", length_of_day) #Remove whitespace
-
-            time_pattern = "<td class=\"c sep\".*?>.*?</td.*?>"
-            match_results = re.findall(time_pattern, date_result, re.IGNORECASE)
-            sunrise = re.sub("span.*?span", "", match_results[0]) #Remove extra info
-            sunrise = re.sub("<.*?>", "", sunrise)
-            sunrise = re.sub("\s*?", "", sunrise)
-
-            time_pattern = "<td class=\"sep c\".*?>.*?</td.*?>"
-            match_results = re.findall(time_pattern, date_result, re.IGNORECASE)
-            sundown = re.sub("span.*?span", "", match_results[0])
-            sundown = re.sub("<.*?>", "", sundown)
-            sundown = re.sub("\s*?", "", sundown)
-
-            #The timeanddate.com will return only '-' in case sundown
-            #happens exactly at midnight.
-            if sundown=='-':
-                sundown='00.00'
-
-            return (length_of_day, sunrise, sundown)
-    except OSError as er:
-        print("Error:",er,url)
-        return ("","","")
-
-
-#Make a plot from given data to width,height space in pixels
-def make_plot_image(x_plot,y_plot,width,height):
-    px = 1/plt.rcParams['figure.dpi'] #one pixel in inches
-    fig, ax = plt.subplots(1,1,figsize=(width*px,height*px))
+        day = date(pre_year, pre_month, pre_date)
+    with metrics.stage("find_sun_info"):
+        return (cache or _sun_info_cache).sun_info(country_name, city_name, day)
+
+
+#The matplotlib figures are kept alive between refreshes, one per plot size, as
+#building and closing a figure every five minutes is slow and churns memory in
+#a process that runs for months.
+_plot_canvases = {}
+
+#Builds the figure, axes, line and zero line for a width,height plot
+def _make_plot_canvas(width,height):
+    Figure = timed_import("matplotlib.figure").Figure
+    FigureCanvasAgg = timed_import("matplotlib.backends.backend_agg").FigureCanvasAgg
+    mpl = timed_import("matplotlib")
+    px = 1/mpl.rcParams['figure.dpi'] #one pixel in inches
+    fig = Figure(figsize=(width*px,height*px))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1,1,1)
     plot_color="white"
     ax.set_xlabel("",color=plot_color)
     ax.set_ylabel("T",color=plot_color)
@@ -412,29 +1029,148 @@ def make_plot_image(x_plot,y_plot,width,height):
     ax.spines['bottom'].set_color(plot_color)
     ax.spines['left'].set_color(plot_color)
     ax.spines['right'].set_color(plot_color)
+    ax.xaxis_date()
+
+    fig.subplots_adjust(left=0.0,right=1.0,top=1.0,bottom=0.0)
+
+    (line,) = ax.plot([],[],color="black")
+    zero_line = ax.axhline(y=0, color="black", linestyle='--')
+    return (canvas, ax, line, zero_line)
+
+#Opens a picture and scales it to fit in resize_lim_w,resize_lim_h pixels,
+#keeping the aspect ratio. The picture is mirrored if flip_pic is True.
+def fit_picture(filename_pic, resize_lim_w, resize_lim_h, flip_pic):
+    with Image.open(filename_pic).convert("RGB") as paste_img:
+        #Can I get automatic contrast/brightness enhancement working?
+        #enhance_color = ImageEnhance.Color(paste_img)
+        #paste_img = enhance_color.enhance(0.0)
+        #enhance_contrast = ImageEnhance.Contrast(paste_img)
+        #paste_img = enhance_contrast.enhance(0.5)
+        #enhance_brightness = ImageEnhance.Brightness(paste_img)
+        #paste_img = enhance_brightness.enhance(0.95)
+
+        resize_x1 = paste_img.size[0]
+        resize_y1 = paste_img.size[1]
+        resize_x2 = paste_img.size[0]
+        resize_y2 = paste_img.size[1]
+        #Test which restriction (x or y) is creating the smaller image and scale with that
+        if resize_y1>resize_lim_h:
+            resize_x1 = round(paste_img.size[0]*resize_lim_h/paste_img.size[1])
+            resize_y1 = resize_lim_h
+        if resize_x2>resize_lim_w:
+            resize_x2 = resize_lim_w
+            resize_y2 = round(paste_img.size[1]*resize_lim_w/paste_img.size[0])
+        if resize_y1<resize_y2:
+            paste_img=paste_img.resize((resize_x1, resize_y1),resample=Image.LANCZOS, reducing_gap=3.0)
+        else:
+            paste_img=paste_img.resize((resize_x2, resize_y2),resample=Image.LANCZOS, reducing_gap=3.0)
 
-    plt.subplots_adjust(left=0.0,right=1.0,top=1.0,bottom=0.0)
-
-    ax.plot(x_plot,y_plot,color="black")
+        if flip_pic:
+            paste_img=paste_img.transpose(method=Image.FLIP_LEFT_RIGHT)
+        return paste_img
 
-    posVal=False
-    negVal=False
-    for iT in y_plot:
-        if iT<0:
-            negVal=True
-        else:
-            posVal=True
-        
-    if posVal and negVal:
-        ax.axhline(y=0, color="black", linestyle='--')
 
-    fig.canvas.draw()
-    plt_img = Image.frombytes("RGB", fig.canvas.get_width_height(), fig.canvas.tostring_rgb())
+#Make a plot from given data to width,height space in pixels. The figure of
+#this size is reused and only the data of the line is changed. The returned
+#image shares its memory with the figure, so it is only valid until the next
+#call with the same size.
+def make_plot_image(x_plot,y_plot,width,height):
+    mplDates = timed_import("matplotlib.dates")
+    np = timed_import("numpy")
+    drawWeather = timed_import("drawWeather")
+    if (width,height) not in _plot_canvases:
+        _plot_canvases[(width,height)] = _make_plot_canvas(width,height)
+    (canvas, ax, line, zero_line) = _plot_canvases[(width,height)]
+
+    #The plot is only some hundred pixels wide, so two points per pixel column are enough
+    (x_plot,y_plot) = drawWeather.downsample(x_plot,y_plot,width)
+    line.set_data(mplDates.date2num(x_plot), y_plot)
+
+    #Draw zero-line only if there are both neg and pos values
+    y_plot = np.asarray(y_plot)
+    zero_line.set_visible(len(y_plot)>0 and y_plot.min()<0 and y_plot.max()>=0)
+
+    #The hidden zero line must not affect the limits
+    ax.relim(visible_only=True)
+    ax.autoscale_view()
+    canvas.draw()
+    (fig_width, fig_height) = canvas.get_width_height()
+    plt_img = Image.frombuffer("RGBA", (fig_width, fig_height), canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
     #plt_img.save("test.png")
-    plt.close('all') #Let's close all possible matplotlib windows so garbage can be collected.
     return plt_img
 
 
+#The limits matplotlib gives to data from low to high: a flat range is first
+#widened by 5 % of the value (0.05 around zero), then 5 % of the range is
+#added on both sides
+def _plot_limits(values):
+    (low, high) = (float(values.min()), float(values.max()))
+    if high-low <= max(abs(low), abs(high))*1e-15:
+        if low==0 and high==0:
+            (low, high) = (-0.05, 0.05)
+        else:
+            (low, high) = (low-0.05*abs(low), high+0.05*abs(high))
+    margin = 0.05*(high-low)
+    return (low-margin, high+margin)
+
+#An approximate make_plot_image drawn straight with PIL without matplotlib.
+#The points are placed where Agg would put them and the lines are drawn at
+#PLOT_SUPERSAMPLE times the size and averaged down, which gives about the
+#same antialiased edges. The line is 1.5 pt at 100 dpi with round joints and
+#projecting caps, and the zero line has the dashes of linestyle '--' snapped
+#to the pixel rows like in matplotlib. It is not a pixel exact match: after
+#the black and white threshold of the display about 5 % of the black pixels
+#differ from the matplotlib plot, mostly along the edges of the line. Takes a
+#few milliseconds instead of building a whole matplotlib figure.
+PLOT_SUPERSAMPLE = 8
+def make_plot_image_pil(x_plot,y_plot,width,height):
+    np = timed_import("numpy")
+    drawWeather = timed_import("drawWeather")
+    scale = PLOT_SUPERSAMPLE
+    plt_img = Image.new("L", (width*scale, height*scale), color=255)
+    draw = ImageDraw.Draw(plt_img)
+
+    (x_plot,y_plot) = drawWeather.downsample(x_plot,y_plot,width)
+    xNum = np.asarray(x_plot).astype(np.float64)
+    yNum = np.asarray(y_plot, dtype=np.float64)
+    #Like matplotlib, a single point has no line to draw
+    if len(yNum)<2:
+        return plt_img.resize((width, height)).convert("RGB")
+
+    #The affine transformation from data to the pixels of Agg, whose y axis
+    #grows upwards. Pixel i covers i..i+1, and the PIL coordinate i is the
+    #centre of the (supersampled) pixel i, hence the half pixel shifts.
+    ((xLow, xHigh), (yLow, yHigh)) = (_plot_limits(xNum), _plot_limits(yNum))
+    xDisp = (xNum-xLow)*(width/(xHigh-xLow))
+    yDisp = (yNum-yLow)*(height/(yHigh-yLow))
+    xPix = xDisp*scale-0.5
+    yPix = (height-yDisp)*scale-0.5
+
+    #1.5 pt at 100 dpi
+    line_width = 1.5*100/72
+    #Projecting caps go on by half the width past both ends
+    for (end, before) in ((0, 1), (-1, -2)):
+        direction = np.array((xPix[end]-xPix[before], yPix[end]-yPix[before]))
+        length = np.hypot(*direction)
+        if length>0:
+            (xPix[end], yPix[end]) = (xPix[end], yPix[end])+direction/length*line_width*scale/2
+    draw.line(list(zip(xPix.tolist(), yPix.tolist())), fill=0,
+              width=round(line_width*scale), joint="curve")
+
+    if yNum.min()<0 and yNum.max()>=0:
+        #A straight line is snapped to the pixel edges, linestyle '--' is 3.7
+        #on and 1.6 off times the line width in points
+        yZero = np.floor(height-(0.0-yLow)*(height/(yHigh-yLow))+0.5)
+        (top, bottom) = (round((yZero-line_width/2)*scale), round((yZero+line_width/2)*scale)-1)
+        (dash_on, dash_off) = (3.7*line_width, 1.6*line_width)
+        xDash = 0.0
+        while xDash<width:
+            draw.rectangle((round(xDash*scale), top, min(round((xDash+dash_on)*scale), width*scale)-1, bottom), fill=0)
+            xDash += dash_on+dash_off
+
+    return plt_img.resize((width, height), resample=Image.BOX).convert("RGB")
+
+
 def sakarin_villapaitapeli_mini(display,up_but,down_but):
     try:
         with Image.open("pics/sakari/peli1.png").convert("RGB") as skr_img:
@@ -477,21 +1213,533 @@ def sakarin_villapaitapeli_mini(display,up_but,down_but):
         print("\nInterrupted. Exiting Sakarin villapaitapeli...")
     return
 
-def select_random_not_this(max_plus_one, not_this_one):
-    while True:
-        ranPic = random.randint(0,max_plus_one)
-        if ranPic!=not_this_one:
-            break
-    return ranPic
+#Turns a logical (rotated) plane of pixels into the physical layout of the
+#framebuffer. Same mapping as adafruit_framebuf uses for each pixel.
+def _unrotate_plane(plane, rotation):
+    if rotation==1:
+        return plane.T[:, ::-1]
+    if rotation==2:
+        return plane[::-1, ::-1]
+    if rotation==3:
+        return plane.T[::-1, :]
+    return plane
+
+#Writes the image straight into the 1-bit framebuffers of the display driver
+#with NumPy, instead of display.image() which goes through it pixel by pixel
+#in Python. The thresholds are the same as in Adafruit_EPD.image(): a pixel is
+#black if all channels are under 0x80 and red if only red is over it. Returns
+#False if the driver does not have the buffers in memory, e.g. with SRAM.
+def pack_image(display,image):
+    np = timed_import("numpy")
+    if image.size!=(display.width, display.height):
+        raise ValueError("Image must be same dimensions as display ({0}x{1}).".format(display.width, display.height))
+    try:
+        if display.sram:
+            return False
+        black_fb = display._blackframebuf
+        color_fb = display._colorframebuf
+        black_inverted = display._black_inverted
+        color_inverted = display._color_inverted
+    except AttributeError:
+        return False
 
-def show_image(display,image):
+    pixels = np.asarray(image.convert("RGB"))
+    dark = pixels<0x80
+    black = dark[:,:,0] & dark[:,:,1] & dark[:,:,2]
+    red = ~dark[:,:,0] & dark[:,:,1] & dark[:,:,2]
+    if black_fb is color_fb:
+        planes = ((black_fb, black|red, black_inverted),)
+    else:
+        planes = ((black_fb, black, black_inverted), (color_fb, red, color_inverted))
+
+    for (framebuf, plane, inverted) in planes:
+        #The stride may be wider than the panel, that part stays white
+        physical = np.zeros((framebuf.height, framebuf.stride), dtype=bool)
+        physical[:, :framebuf.width] = _unrotate_plane(plane, framebuf.rotation)
+        if inverted:
+            physical = ~physical
+        framebuf.buf[:] = np.packbits(physical, axis=1, bitorder='big').tobytes()
+    return True
+
+#Gives the window of the panel RAM where the black plane of the display
+#differs from previous_black, as (first byte, last byte, first row, last row)
+#of the packed buffer, or None if nothing changed. The buffer is compared as
+#it is sent, so the window is in the coordinates of the panel whatever the
+#rotation.
+def dirty_window(display, previous_black):
+    np = timed_import("numpy")
+    row_bytes = display._blackframebuf.stride//8
+    old = np.frombuffer(previous_black, dtype=np.uint8).reshape(-1, row_bytes)
+    new = np.frombuffer(display._buffer1, dtype=np.uint8).reshape(-1, row_bytes)
+    changed = old!=new
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows)==0:
+        return None
+    cols = np.flatnonzero(changed.any(axis=0))
+    return (int(cols[0]), int(cols[-1]), int(rows[0]), int(rows[-1]))
+
+#SSD1680 with a partial refresh. The new frame goes to the black/white RAM
+#and the previous one to the red RAM, and display mode 2 only drives the
+#pixels that differ between them. Only the window of the RAM that changed is
+#sent. After the refresh the window is written to the red RAM too, so both
+#RAMs hold the frame on the panel and the pixels outside the next window are
+#left alone. The RAM is kept in the deep sleep between refreshes. A full
+#refresh puts the color plane in the red RAM, so the first partial refresh
+#after it sends the whole frame. This is faster and does not flash the whole
+#panel, but leaves some ghosting, so a full refresh should be done every now
+#and then.
+class PartialSSD1680(Adafruit_SSD1680):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #True when the red RAM has the same frame as the black/white RAM
+        self._rams_same=False
+
+    def _write_window(self, index, buf, window):
+        (x_first, x_last, y_first, y_last) = window
+        row_bytes = self._blackframebuf.stride//8
+        self.command(0x44, bytearray([x_first, x_last]))
+        self.command(0x45, bytearray([y_first & 0xFF, y_first >> 8, y_last & 0xFF, y_last >> 8]))
+        self.command(0x4E, bytearray([x_first]))
+        self.command(0x4F, bytearray([y_first & 0xFF, y_first >> 8]))
+        data = b"".join(bytes(buf[row*row_bytes+x_first:row*row_bytes+x_last+1])
+                        for row in range(y_first, y_last+1))
+        self.write_ram(index)
+        while not self.spi_device.try_lock():
+            time.sleep(0.01)
+        self._dc.value = True
+        self.spi_device.write(data)
+        self._cs.value = True
+        self.spi_device.unlock()
+
+    def display(self):
+        super().display()
+        self._rams_same=False
+
+    #window is from dirty_window(), None sends the whole frame
+    def partial_display(self, previous_black, window=None):
+        full_window = (0, self._blackframebuf.stride//8-1, 0, len(self._buffer1)*8//self._blackframebuf.stride-1)
+        if window is None or not self._rams_same:
+            window = full_window
+        #The display update control 0x21 stays at its reset default like in
+        #the full refresh: both RAMs are used as they are, on all sources
+        self.power_up()
+        self._write_window(0, self._buffer1, window)
+        self._write_window(1, previous_black, window)
+        #Display mode 2 (partial), then turn the analog and the clock off
+        self.command(0x22, bytearray([0xFF]))
+        self.command(0x20)
+        self.busy_wait()
+        if not self._busy:
+            time.sleep(1)
+        self._write_window(1, self._buffer1, window)
+        self._rams_same=True
+        self.power_down()
+
+#Pushes frames to the display and remembers the last one. A frame that is the
+#same as the one on the panel is not refreshed at all. If partial is True and
+#the display has partial_display, changed frames are shown with a partial
+#refresh and every full_every:th update is a full one to clear the ghosting.
+class FramePusher:
+    def __init__(self,l_display,l_full_every=10,l_partial=False):
+        self.display=l_display
+        self.full_every=l_full_every
+        self.partial=l_partial
+        self.last_hash=None
+        self.last_black=None
+        self.updates_since_full=0
+        #The frame on the panel is saved here after every refresh, so a
+        #restart knows what the panel shows, see load_state()
+        self.state_file=None
+        #The frames may come from more than one thread
+        self.lock=threading.Lock()
+
+    #Takes a newly opened display in use. Its panel is unknown, so the next
+    #frame is a full refresh.
+    def set_display(self,new_display):
+        with self.lock:
+            self.display=new_display
+            self.last_hash=None
+            self.last_black=None
+            self.updates_since_full=0
+
+    #Saves the frame on the panel, so that after a restart the same frame is
+    #not refreshed again and the next change can be a partial refresh. Every
+    #refresh is saved, whether it was the weather, the sun view or the game.
+    def _save_state(self):
+        np = timed_import("numpy")
+        if not self.state_file or not hasattr(self.display, "_buffer1"):
+            return
+        try:
+            os.makedirs(path.dirname(self.state_file) or ".", exist_ok=True)
+            meta = {"width": self.width,
+                    "height": self.height,
+                    "rotation": self.display.rotation,
+                    "hash": self.last_hash.hex(),
+                    "updates_since_full": self.updates_since_full}
+            with open(self.state_file+".tmp", "wb") as fil:
+                np.savez(fil, meta=np.array(json.dumps(meta)),
+                         black=np.frombuffer(bytes(self.display._buffer1), dtype=np.uint8),
+                         color=np.frombuffer(bytes(self.display._buffer2), dtype=np.uint8))
+            os.replace(self.state_file+".tmp", self.state_file)
+        except OSError as err:
+            print("Could not save the frame:", err)
+
+    #Takes the frame saved in state_file as the one on the panel, if it was
+    #saved from a display of the same size. Returns True if it was used.
+    def load_state(self):
+        np = timed_import("numpy")
+        if not self.state_file:
+            return False
+        try:
+            with np.load(self.state_file) as saved:
+                meta = json.loads(str(saved["meta"]))
+                (black, color) = (saved["black"], saved["color"])
+        except (OSError, ValueError, KeyError) as err:
+            print("Could not load the saved frame:", err)
+            return False
+        with self.lock:
+            if ((meta["width"], meta["height"], meta["rotation"])!=(self.width, self.height, self.display.rotation)
+                    or not hasattr(self.display, "_buffer1") or len(black)!=len(self.display._buffer1)
+                    or len(color)!=len(self.display._buffer2)):
+                return False
+            #The panel keeps showing the frame while we are not running
+            self.display._buffer1[:] = black.tobytes()
+            self.display._buffer2[:] = color.tobytes()
+            self.last_hash = bytes.fromhex(meta["hash"])
+            self.last_black = black.tobytes()
+            self.updates_since_full = meta["updates_since_full"]
+        return True
+
+    @property
+    def width(self):
+        return self.display.width
+
+    @property
+    def height(self):
+        return self.display.height
+
+    #Shows the image. Returns "skipped", "partial" or "full".
+    def push(self,image,force=False):
+        with self.lock:
+            return self._push(image,force)
+
+    def _push(self,image,force):
+        with metrics.stage("pack_image"):
+            if pack_image(self.display,image):
+                frame = bytes(self.display._blackframebuf.buf)+bytes(self.display._colorframebuf.buf)
+            else:
+                self.display.fill(Adafruit_EPD.WHITE)
+                self.display.image(image)
+                frame = image.convert("RGB").tobytes()
+        frame_hash = hashlib.sha1(frame).digest()
+        if frame_hash==self.last_hash and not force:
+            return "skipped"
+
+        can_partial = (self.partial and self.last_black is not None and
+                       hasattr(self.display, "partial_display"))
+        if can_partial and self.updates_since_full+1<self.full_every:
+            window = dirty_window(self.display, self.last_black)
+            with metrics.stage("display_partial"):
+                self.display.partial_display(self.last_black, window)
+            self.updates_since_full+=1
+            result = "partial"
+        else:
+            with metrics.stage("display_full"):
+                self.display.display()
+            self.updates_since_full=0
+            result = "full"
+        self.last_hash = frame_hash
+        if hasattr(self.display, "_buffer1"):
+            self.last_black = bytes(self.display._buffer1)
+        self._save_state()
+        return result
+
+#Runs the display with asyncio. The weather frame is refreshed every five
+#minutes by its own task and the button gestures are handled by another. The
+#rendering runs in a single worker thread and the network fetch of the sun
+#view in the default executor with a timeout, so a slow response or a long
+#plot never blocks the input. All pushes to the display go through one lock.
+#A gesture that asks for a new weather frame cancels the render in progress
+#and starts the five minutes from the beginning.
+class DisplayScheduler:
+    def __init__(self,l_screen,l_image_manip,l_library,l_buttons,l_game_buttons,l_show_this_pic,l_rand):
+        self.screen=l_screen
+        self.image_manip=l_image_manip
+        self.library=l_library
+        self.buttons=l_buttons
+        self.game_buttons=l_game_buttons
+        self.show_this_pic=l_show_this_pic
+        self.randomize_every_update=l_rand
+        self.override_randomizer=False
+        self.reread_weather=True
+        self.refresh_interval=300
+        #The weather frame is rendered this many seconds before it is due, so
+        #it is ready to be pushed when the five minutes are up
+        self.prerender_lead=30
+        self.sun_place=("finland","jyvaskyla")
+        #Gives the sun info tuple of today, timeanddate.com by default
+        self.find_sun=lambda: find_sun_info(*self.sun_place)
+        self.sun_timeout=15
+        self.onetime=False
+        self.importtime=False
+        #Where the metrics are written after every refresh, see metrics.py
+        self.prom_file=None
+        self.status_file=None
+        #With --daemon: the heartbeat file, how long a refresh may take before
+        #the heartbeat stops, and a function that opens the display again
+        self.heartbeat=None
+        self.display_timeout=60
+        self.reinit_display=None
+        self.push_started=None
+        self.ready=False
+        #The folder where the state is saved after every weather frame, so a
+        #restart carries on where this run stopped, see load_state()
+        self.state_folder=None
+        #Renders one frame at a time, a cancelled render finishes before the
+        #next one starts so they never share the plot canvas
+        self.render_pool=timed_import("concurrent.futures").ThreadPoolExecutor(1)
+
+    #Runs until --onetime is done, an error happens or the user interrupts
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.display_lock = asyncio.Lock()
+        self.gestures = asyncio.Queue()
+        self.game_running = False
+        self.done = self.loop.create_future()
+        threading.Thread(target=self._gesture_bridge, daemon=True).start()
+        self.weather_task = self._start(self._weather_loop(self.loop.time()))
+        self.sun_task = None
+        input_task = self._start(self._input_loop())
+        heartbeat_task = self._start(self._heartbeat_loop())
+        try:
+            await self.done
+        finally:
+            for task in (self.weather_task, self.sun_task, input_task, heartbeat_task):
+                if task:
+                    task.cancel()
+            self.render_pool.shutdown(wait=False)
+
+    def _start(self,coroutine):
+        task = self.loop.create_task(coroutine)
+        task.add_done_callback(self._task_done)
+        return task
+
+    #An error in any task ends run() with that error
+    def _task_done(self,task):
+        if task.cancelled() or self.done.done():
+            return
+        if task.exception():
+            self.done.set_exception(task.exception())
+
+    #Moves the gestures of ButtonEvents from its thread to the event loop
+    def _gesture_bridge(self):
+        while True:
+            gesture = self.buttons.wait()
+            try:
+                self.loop.call_soon_threadsafe(self._put_gesture, gesture)
+            except RuntimeError:
+                #The event loop has been closed
+                return
+
+    #The presses made while playing the game are not gestures
+    def _put_gesture(self,gesture):
+        if not self.game_running:
+            self.gestures.put_nowait(gesture)
+
+    async def _render(self,function,*args):
+        return await self.loop.run_in_executor(self.render_pool, function, *args)
+
+    async def _push(self,image,force=False):
+        #If image was not successfully made, show_image exits
+        if not image:
+            show_image(self.screen,image)
+        async with self.display_lock:
+            try:
+                await self._push_locked(image, force)
+            except OSError as err:
+                if not self.reinit_display:
+                    raise
+                #The SPI or the pins have failed, open the display again and retry
+                print("Error: The display failed, opening it again. Message:", err)
+                display = await self.loop.run_in_executor(None, self.reinit_display)
+                self.screen.set_display(display)
+                await self._push_locked(image, True)
+        if not self.ready:
+            self.ready = True
+            supervisor.sd_notify("READY=1")
+        self._write_metrics()
+
+    async def _push_locked(self,image,force):
+        self.push_started = time.monotonic()
+        pushing = self.loop.run_in_executor(None, show_image, self.screen, image, force)
+        try:
+            await asyncio.shield(pushing)
+        except asyncio.CancelledError:
+            #A refresh cannot be stopped halfway, keep the lock until it ends
+            await pushing
+            raise
+        finally:
+            self.push_started = None
+
+    #Touches the heartbeat file and pings the systemd watchdog every ten
+    #seconds, unless a refresh of the display has hung. Then the supervisor
+    #or systemd restarts us.
+    async def _heartbeat_loop(self):
+        if not self.heartbeat and not os.environ.get("NOTIFY_SOCKET"):
+            return
+        while True:
+            if self.push_started and time.monotonic()-self.push_started > self.display_timeout:
+                print("Error: The display has not answered in {:.0f} s".format(time.monotonic()-self.push_started))
+            else:
+                if self.heartbeat:
+                    try:
+                        supervisor.beat(self.heartbeat)
+                    except OSError as err:
+                        print("Could not write the heartbeat:", err)
+                supervisor.sd_notify("WATCHDOG=1")
+            await asyncio.sleep(10)
+
+    def _write_metrics(self):
+        try:
+            if self.prom_file:
+                metrics.write_prometheus(self.prom_file)
+            if self.status_file:
+                metrics.write_json(self.status_file)
+        except OSError as err:
+            print("Could not write the metrics:", err)
+
+    #Saves the settings and the place of the weather reader with its rows.
+    #Runs in the render thread, which owns the reader. The frame on the panel
+    #is saved by FramePusher after every refresh.
+    def save_state(self):
+        if not self.state_folder:
+            return
+        try:
+            os.makedirs(self.state_folder, exist_ok=True)
+            self.image_manip.follower.save_state(path.join(self.state_folder, "weather.npz"))
+            state = {"time": time.time(),
+                     "show_this_pic": self.show_this_pic,
+                     "settings": self.image_manip.settings()}
+            with open(path.join(self.state_folder, "state.json.tmp"), "w") as fil:
+                json.dump(state, fil, indent=1)
+            os.replace(path.join(self.state_folder, "state.json.tmp"), path.join(self.state_folder, "state.json"))
+        except OSError as err:
+            print("Could not save the state:", err)
+
+    #Takes the state of the last run in use before run(). The weather reader
+    #reads only the rows written since, and the first frame is not refreshed
+    #at all if it is the same as the one already on the panel.
+    def load_state(self):
+        if not self.state_folder:
+            return
+        try:
+            with open(path.join(self.state_folder, "state.json")) as fil:
+                state = json.load(fil)
+        except (OSError, ValueError):
+            return
+        self.image_manip.restore_settings(state.get("settings", {}))
+        if state.get("show_this_pic") in self.library.pictures:
+            self.show_this_pic = state["show_this_pic"]
+        weather = self.image_manip.follower.load_state(path.join(self.state_folder, "weather.npz"))
+        frame = self.screen.load_state()
+        print("Warm start from the state of {} (weather rows: {}, frame: {})".format(
+            datetime.fromtimestamp(state.get("time", 0)).isoformat(timespec="seconds"),
+            "kept" if weather else "read again", "kept" if frame else "refreshed"))
+
+    def _pick_picture(self):
+        #New pictures in the folder are noticed without a restart
+        if self.library.refresh() and self.show_this_pic not in self.library.pictures:
+            self.show_this_pic = self.library.default_picture()
+        if self.randomize_every_update and not self.override_randomizer:
+            self.show_this_pic = self.library.next_random()
+        self.override_randomizer = False
+        return self.show_this_pic
+
+    #due is the loop.time() when the first frame is shown, the next ones are
+    #shown refresh_interval apart from it
+    async def _weather_loop(self,due):
+        while True:
+            await asyncio.sleep(due-self.prerender_lead-self.loop.time())
+            pic = await self._render(self._pick_picture)
+            image = await self._render(self.image_manip.create_weather_image,
+                                       pic, "yuuka" in pic, self.reread_weather)
+            self.reread_weather = True
+            await asyncio.sleep(due-self.loop.time())
+            await self._push(image)
+            await self._render(self.save_state)
+            if self.importtime:
+                print_import_report()
+                self.importtime = False
+            if self.onetime:
+                self.done.set_result(None)
+                return
+            due = max(due+self.refresh_interval, self.loop.time())
+
+    async def _show_sun(self):
+        fetch = self.loop.run_in_executor(None, self.find_sun)
+        try:
+            sun_info = await asyncio.wait_for(fetch, self.sun_timeout)
+        except asyncio.TimeoutError:
+            print("Error: No sun info in",self.sun_timeout,"seconds")
+            sun_info = ("","","")
+        image = await self._render(self.image_manip.create_sun_image, *self.sun_place, sun_info)
+        await self._push(image)
+
+    def _cancel_frames(self):
+        self.weather_task.cancel()
+        if self.sun_task:
+            self.sun_task.cancel()
+
+    async def _input_loop(self):
+        while True:
+            (n1, n2) = await self.gestures.get()
+            refresh_weather_now = False
+            if n1>0 and n2==0:
+                if n1==2:
+                    if self.sun_task:
+                        self.sun_task.cancel()
+                    self.sun_task = self._start(self._show_sun())
+                else:
+                    await self._render(self.image_manip.switch_in_out)
+                    #The other device is already in memory
+                    self.reread_weather = False
+                    refresh_weather_now = True
+            #We can decide the wanted pic by the number of presses
+            if n2>0 and n1==0:
+                self.show_this_pic = self.library.pictures[(n2-1)%len(self.library)]
+                self.override_randomizer = True
+                refresh_weather_now = True
+
+            if n1==3 and n2==3:
+                self._cancel_frames()
+                self.game_running = True
+                try:
+                    async with self.display_lock:
+                        await self.loop.run_in_executor(None, sakarin_villapaitapeli_mini,
+                                                        self.screen, *self.game_buttons)
+                finally:
+                    self.buttons.clear()
+                    #Let the gestures already on their way from the bridge through
+                    await asyncio.sleep(0)
+                    while not self.gestures.empty():
+                        self.gestures.get_nowait()
+                    self.game_running = False
+                refresh_weather_now = True
+
+            if refresh_weather_now:
+                #The frame being rendered is old now
+                self._cancel_frames()
+                self.weather_task = self._start(self._weather_loop(self.loop.time()))
+
+def show_image(screen,image,force=False):
     if not image:
         print("Error: No image produced which should be shown, exiting...")
         exit()
-    display.fill(Adafruit_EPD.WHITE)
-    display.image(image)
-    display.display()
-    return
+    with metrics.stage("show_image"):
+        return screen.push(image,force)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="This displays the weather information measured by readRuuvi.py in an Raspberry pi e-ink display. The display is updated every five minutes starting from the time the program is first run. The first button changes between inside and outside weather information, and the second button refreshes the screen, starting the five minute timer from the beginning.",
@@ -526,50 +1774,189 @@ if __name__ == "__main__":
                         default=False)
     parser.add_argument("--fpstest",
                         "-t",
-                        help="Run a test for how long the screen takes to update.",
+                        help="Test how long the screen takes to update, and exit. The render, pack, transfer and busy times are measured separately.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--fpsframes",
+                        help="With --fpstest, the number of refreshes of each scenario.",
+                        type=int,
+                        default=10)
+    parser.add_argument("--fpsscenarios",
+                        help="With --fpstest, the scenarios to run: a blank frame, text only, the weather frame, and a partial refresh of a corner.",
+                        nargs="+",
+                        choices=["blank", "text", "weather", "partial"],
+                        default=["blank", "text", "weather", "partial"])
+    parser.add_argument("--fpsoutput",
+                        help="With --fpstest, write the results as JSON to this file.",
+                        default=None)
+    parser.add_argument("--plotbackend",
+                        "-p",
+                        help="Draw the weather plot with matplotlib or straight with PIL, which is much faster but only approximates the matplotlib plot.",
+                        choices=["matplotlib", "pil"],
+                        default="matplotlib")
+    parser.add_argument("--importtime",
+                        "-i",
+                        help="Print how long the imports took and the time to the first frame.",
                         action="store_true",
                         default=False)
+    parser.add_argument("--plotcache",
+                        "-c",
+                        help="A folder where the rendered plots are also saved so they survive a restart.",
+                        type=str,
+                        nargs='?',
+                        default=None)
+    parser.add_argument("--piccache",
+                        "-C",
+                        help="A folder where the resized pictures are also saved so they survive a restart. By default 'fitted' in the --library folder.",
+                        type=str,
+                        nargs='?',
+                        default=None)
+    parser.add_argument("--library",
+                        "-l",
+                        help="The folder where the index of the pictures is kept. By default a folder for the picture folder in ~/.cache/e-display/library.",
+                        type=str,
+                        nargs='?',
+                        default=None)
+    parser.add_argument("--partial",
+                        "-P",
+                        help="Use partial refreshes of the display when the frame changes.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--fullevery",
+                        "-F",
+                        help="With --partial, do a full refresh every this many updates to clear ghosting.",
+                        type=int,
+                        default=10)
+    parser.add_argument("--buttons",
+                        "-b",
+                        help="Where the button presses are read from: RPi.GPIO edge interrupts (gpio), a thread polling the pins (poll), or gpio if it is available (auto, the default).",
+                        choices=["auto", "gpio", "poll"],
+                        default="auto")
+    parser.add_argument("--sunsource",
+                        "-s",
+                        help="Compute the sunrise and sunset locally (local, the default), or read them from timeanddate.com (web).",
+                        choices=["local", "web"],
+                        default="local")
+    parser.add_argument("--location",
+                        "-L",
+                        help="Latitude and longitude in degrees for --sunsource local, Jyväskylä by default.",
+                        nargs=2,
+                        type=float,
+                        metavar=("LAT", "LON"),
+                        default=(62.2415, 25.7209))
+    parser.add_argument("--suncache",
+                        help="Folder where the month tables of --sunsource web are kept between runs.",
+                        default=path.join(path.expanduser("~"), ".cache", "e-display", "sun"))
+    parser.add_argument("--promfile",
+                        help="Write the timings of the refresh stages after every refresh to this file, for the textfile collector of Prometheus node_exporter (name must end with .prom).",
+                        default=None)
+    parser.add_argument("--statusfile",
+                        help="Write the timings of the refresh stages after every refresh to this JSON file.",
+                        default=None)
+    parser.add_argument("--daemon",
+                        "-D",
+                        help="Run as a service: exit if another instance has --lockfile, touch --heartbeat (and notify systemd if started with Type=notify) while working, and open the display again if it fails. See supervisor.py.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--lockfile",
+                        help="With --daemon, the lock file that keeps this a single instance.",
+                        default=supervisor.DEFAULT_LOCKFILE)
+    parser.add_argument("--heartbeat",
+                        help="With --daemon, the file touched every ten seconds while the display works.",
+                        default=supervisor.DEFAULT_HEARTBEAT)
+    parser.add_argument("--displaytimeout",
+                        help="With --daemon, the heartbeat stops if a refresh of the display takes longer than this many seconds.",
+                        type=float,
+                        default=60)
+    parser.add_argument("--statedir",
+                        help="Folder where the settings, the place in the weather file and the frame on the display are saved after every refresh, and loaded from at the start.",
+                        default=path.join(path.expanduser("~"), ".cache", "e-display", "state"))
+    parser.add_argument("--coldstart",
+                        help="Do not load the state saved in --statedir, start from scratch.",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--backend",
+                        help="Use the e-ink bonnet (hardware, the default), or a virtual display and buttons for running without the Pi (virtual).",
+                        choices=["hardware", "virtual"],
+                        default="hardware")
+    parser.add_argument("--frames",
+                        help="With --backend virtual, the folder where every refresh of the display is saved.",
+                        default=None)
+    parser.add_argument("--framesformat",
+                        help="With --frames, save the frames as PNG images (png, the default) or as the raw black and red buffers (raw).",
+                        choices=["png", "raw"],
+                        default="png")
+    parser.add_argument("--presses",
+                        help="With --backend virtual, the button presses as button:seconds from the start, e.g. 1:2.0,2:4.0,2:4.2",
+                        default="")
     args = parser.parse_args()
 
-    spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
-    ecs = digitalio.DigitalInOut(board.CE0)
-    dc = digitalio.DigitalInOut(board.D22)
-    rst = digitalio.DigitalInOut(board.D27)
-    busy = digitalio.DigitalInOut(board.D17)
-    up_button = digitalio.DigitalInOut(board.D6)
-    up_button.switch_to_input()
-    down_button = digitalio.DigitalInOut(board.D5)
-    down_button.switch_to_input()
-
-    #print(find_sun_info("finland","jyvaskyla",2023,3,31))
-
-    # Initialize the Display
-    display = Adafruit_SSD1680(     # Newer eInk Bonnet
-        122, 250, spi, cs_pin=ecs, dc_pin=dc, sramcs_pin=None, rst_pin=rst, busy_pin=busy,
-    )
-
-    display.rotation = 1
+    if args.daemon:
+        #Only one display_continuous.py may drive the display
+        instance_lock = supervisor.acquire_lock(args.lockfile)
+        if not instance_lock:
+            print("Already running (pid {}), exiting".format(supervisor.lock_owner(args.lockfile)))
+            exit()
+
+    if args.backend=="virtual":
+        virtualHardware = timed_import("virtualHardware")
+        (up_button, down_button) = virtualHardware.scripted_buttons(args.presses)
+        button_pins = (None, None)
+        def open_display():
+            display = virtualHardware.VirtualSSD1680(122, 250, args.frames, args.framesformat)
+            display.rotation = 1
+            return display
+    else:
+        if hardware_import_error:
+            raise hardware_import_error
+        up_button = digitalio.DigitalInOut(board.D6)
+        up_button.switch_to_input()
+        down_button = digitalio.DigitalInOut(board.D5)
+        down_button.switch_to_input()
+        button_pins = (board.D6, board.D5)
+
+        #print(find_sun_info("finland","jyvaskyla",2023,3,31))
+
+        #Opening the display again releases its pins and SPI first, this is
+        #how a display that has stopped answering is recovered
+        display_pins = []
+        def open_display():
+            for pin in display_pins:
+                pin.deinit()
+            spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
+            ecs = digitalio.DigitalInOut(board.CE0)
+            dc = digitalio.DigitalInOut(board.D22)
+            rst = digitalio.DigitalInOut(board.D27)
+            busy = digitalio.DigitalInOut(board.D17)
+            display_pins[:] = [spi, ecs, dc, rst, busy]
+
+            # Initialize the Display
+            display_class = PartialSSD1680 if args.partial else Adafruit_SSD1680
+            display = display_class(     # Newer eInk Bonnet
+                122, 250, spi, cs_pin=ecs, dc_pin=dc, sramcs_pin=None, rst_pin=rst, busy_pin=busy,
+            )
+            display.rotation = 1
+            return display
+
+    display = open_display()
+    screen = FramePusher(display, args.fullevery, args.partial)
 
-    filenames = []
-    totalPics = 0
-    defPic = 0
     #Find all black and whit (bw) pics in the picture folder and list them.
-    #"yuuka" picture is the default one.
-    for (dirpath, dirnames, fnames) in walk(args.picfolder):
-        #Nice to have the files in alphabetical order
-        fnames = sorted(fnames)
-        for fname in fnames:
-            if "bw" in fname:
-                filenames.append(path.join(dirpath,fname))
-                if args.defpic in fname:
-                    defPic=totalPics
-                totalPics+=1
-
-    if len(filenames)==0:
+    def keep_alive():
+        #The first index of a big picture folder may take longer than the
+        #supervisor waits for the first heartbeat
+        if args.daemon:
+            try:
+                supervisor.beat(args.heartbeat)
+            except OSError as err:
+                print("Could not write the heartbeat:", err)
+            supervisor.sd_notify("WATCHDOG=1")
+    library = PictureLibrary(args.picfolder, args.defpic, args.library, keep_alive)
+
+    if len(library)==0:
         print("No files found for pic, terminating")
         exit()
 
-    weather_refresh = None
     #i=0
 
     show_in_out = 1
@@ -577,61 +1964,63 @@ if __name__ == "__main__":
         #If pic is choosen randomly every time, we would like to
         #see the default picture also happen sometime when the
         #program is ran the first time.
-        show_this_pic = -1
+        show_this_pic = None
     else:
-        show_this_pic = defPic
-    randomize_every_update = args.rand
-    override_randomizer = False
+        show_this_pic = library.default_picture()
     down_button_pressed = False
     image_manip = WeatherImageManipulations(args.weatherfile,
                   "e6:89:18:c1:32:1f", "fc:41:f4:c5:0c:08",
                   display.width, display.height)
-    listener = ListenButtons()
-    listener.set_resetting_time(0.8)
+    image_manip.set_plot_backend(args.plotbackend)
+    if args.plotcache:
+        image_manip.set_plot_cache(ImageCache(l_folder=args.plotcache))
+    #The fitted pictures are kept with the index by default, so a restart
+    #does not resize the originals again
+    piccache = args.piccache or (library.library_folder and path.join(library.library_folder, "fitted"))
+    if piccache:
+        image_manip.set_pic_cache(ImageCache(l_max_bytes=4*1024*1024, l_folder=piccache,
+                                             l_max_files=max(256, len(library))))
+    #The virtual buttons can only be polled
+    buttons = ButtonEvents((up_button, down_button), button_pins,
+                           "poll" if args.backend=="virtual" else args.buttons)
     if args.fpstest:
-        image_manip.fps_test(display,True)
+        results = image_manip.fps_test(display, args.fpsframes, args.fpsscenarios,
+                                       library.default_picture())
+        if args.fpsoutput:
+            with open(args.fpsoutput, "w") as fil:
+                json.dump({"date": datetime.now().isoformat(timespec="seconds"),
+                           "display": type(display).__name__,
+                           "frames": args.fpsframes,
+                           "results": results}, fil, indent=1)
+        exit()
+    scheduler = DisplayScheduler(screen, image_manip, library, buttons, (up_button, down_button),
+                                 show_this_pic, args.rand)
+    if args.sunsource=="local":
+        #The sun info of the whole year is ready before the first double press
+        sun_table = timed_import("sunCalc").SunTable(*args.location)
+        scheduler.find_sun = sun_table.sun_info
+    else:
+        sun_cache = SunInfoCache(args.suncache)
+        scheduler.find_sun = lambda: find_sun_info(*scheduler.sun_place, cache=sun_cache)
+        #This month is fetched already, so the first sun view is instant too
+        today = date.today()
+        sun_cache.prefetch(*scheduler.sun_place, today.year, today.month)
+    scheduler.onetime = args.onetime
+    if args.daemon:
+        scheduler.heartbeat = args.heartbeat
+        scheduler.display_timeout = args.displaytimeout
+        scheduler.reinit_display = open_display
+    if args.promfile or args.statusfile:
+        metrics.enable()
+        scheduler.prom_file = args.promfile
+        scheduler.status_file = args.statusfile
+    scheduler.importtime = args.importtime
+    scheduler.state_folder = args.statedir
+    screen.state_file = path.join(args.statedir, "frame.npz")
+    if not args.coldstart:
+        scheduler.load_state()
     try:
-        while True:
-            # only query the weather every 5 minutes (and on first run)
-            if (not weather_refresh) or (time.monotonic() - weather_refresh) > 300:
-                if randomize_every_update and not override_randomizer:
-                    show_this_pic = select_random_not_this(totalPics,show_this_pic)
-                weather_refresh = time.monotonic()
-                #timing1 = time.perf_counter()
-                image = image_manip.create_weather_image(filenames[show_this_pic],
-                                                        "yuuka" in filenames[show_this_pic])
-                #timing2 = time.perf_counter()
-                #print("Timing:",timing2-timing1)
-
-                #If image was not successfully made, lets try another time in a new loop
-                show_image(display,image)
-
-            if args.onetime:
-                break
-
-            override_randomizer = False
-            if listener.check_button_state(up_button.value,down_button.value):
-                if listener.n1>0 and listener.n2==0:
-                    if listener.n1==2:
-                        image = image_manip.create_sun_image("finland","jyvaskyla")
-                        show_image(display,image)
-                    else:
-                        image_manip.switch_in_out()
-                        weather_refresh=None
-                #We can decide the wanted pic by the number of presses
-                if listener.n2>0 and listener.n1==0:
-                    show_this_pic = (listener.n2-1)%totalPics
-                    override_randomizer = True
-                    weather_refresh=None
-                
-                if listener.n1==3 and listener.n2==3:
-                    sakarin_villapaitapeli_mini(display,up_button,down_button)
-                    weather_refresh=None
-
-            #In order to not overburden cpu
-            time.sleep(0.05)
-            #print("test",i,"button1:",up_button.value,"button2:",down_button.value)
-            #i+=1
+        scheduler.run()
     except KeyboardInterrupt:
         print("\nInterrupted. Exiting program...")
 
@@ -1,57 +1,502 @@
 
-def get_weather_data(filename, devicename, days, skip_lines=0):
+import os
+import json
+import metrics
+from os import path
+from collections import deque
+
+#The two header rows (device names and column labels) only change when
+#readRuuvi.py starts a new file, so they are parsed once and kept here.
+_header_cache = {}
+
+#Reads and caches the header rows of a readRuuvi.py CSV file. Returns a dict with
+#the device names of row 0, the pretty labels of row 1 and the byte offset where
+#the data rows start. The cache is dropped if the file is replaced or shrinks.
+def read_header(filename):
+    stat = os.stat(filename)
+    cached = _header_cache.get(filename)
+    if cached and cached["inode"]==stat.st_ino and cached["size"]<=stat.st_size:
+        cached["size"] = stat.st_size
+        return cached
+
+    with open(filename, 'rb') as fil:
+        row0 = fil.readline().decode("utf-8")
+        row1 = fil.readline().decode("utf-8")
+        data_start = fil.tell()
+    devices = [dev.strip() for dev in row0.split(',')]
+    splitter = row1.split(',')
+    yLab = []
+    #Manipulate labels to be more pleasing.
+    brac_ind = splitter[3].find('[')
+    yLab.append(splitter[3][:brac_ind] +' [°'+ splitter[3][brac_ind+1:])
+    brac_ind = splitter[2].find('[')
+    yLab.append(splitter[2][:brac_ind] +' '+ splitter[2][brac_ind:])
+    brac_ind = splitter[4].find('[')
+    yLab.append(splitter[4][:brac_ind] +' [k'+ splitter[4][brac_ind+1:])
+
+    cached = {"inode": stat.st_ino,
+              "size": stat.st_size,
+              "devices": devices,
+              "xLab": "Time",
+              "yLab": yLab,
+              "n_columns": len(splitter),
+              "data_start": data_start}
+    _header_cache[filename] = cached
+    return cached
+
+#Gives the time of a data row given as bytes
+def row_time(line):
+    import numpy as np
+    splitter = line.decode("utf-8").split(',')
+    return np.datetime64("{}T{}".format(splitter[0],splitter[1]))
+
+#Returns the offset of the first line that starts at or after pos.
+def _line_start_at(fil, pos, data_start):
+    if pos<=data_start:
+        return data_start
+    fil.seek(pos-1)
+    fil.readline()
+    return fil.tell()
+
+#Finds the byte offset of the first row newer than cutoff. The rows are written
+#in time order, so we can do a binary search over the byte offsets and read
+#only a couple of lines per probe instead of going through the whole file.
+def find_window_offset(fil, data_start, file_end, cutoff):
+    low = data_start
+    high = file_end
+    while low<high:
+        mid = (low+high)//2
+        start = _line_start_at(fil, mid, data_start)
+        fil.seek(start)
+        line = fil.readline()
+        #A missing or half written last row counts as being inside the window
+        if not line.endswith(b'\n'):
+            high = mid
+            continue
+        try:
+            newer = row_time(line) > cutoff
+        except (ValueError, IndexError):
+            newer = False
+        if newer:
+            high = mid
+        else:
+            low = mid+1
+    return _line_start_at(fil, low, data_start)
+
+#Parses a block of complete data rows (bytes) in one go instead of row by row.
+#The fields are split with a single str.split, the times are converted with one
+#vectorized datetime64 conversion and the values with one float conversion per
+#column. The single split is only used if every row has the same number of
+#fields, so ragged rows are never shifted into the wrong columns. Returns the
+#times as a datetime64 array and a dict of devInd: (temp, humidi, pressure)
+#float arrays for the given devInds, pressure in kPa.
+def parse_block(data, devInds):
+    import numpy as np
+    text = data.decode("utf-8").rstrip('\n')
+    if not text:
+        return (np.array([], dtype='datetime64[s]'),
+                {devInd: (np.array([]), np.array([]), np.array([])) for devInd in devInds})
+    lines = text.split('\n')
+    nCols = lines[0].count(',')+1
+    if (np.char.count(np.array(lines), ',')==nCols-1).all():
+        fields = text.replace('\n', ',').split(',')
+        column = lambda ind: fields[ind::nCols]
+    else:
+        #Not every row has the same number of columns, so split them one by one
+        rows = [row.split(',') for row in lines]
+        column = lambda ind: [row[ind] for row in rows]
+
+    meas_time = np.char.add(np.char.add(np.array(column(0)), 'T'), np.array(column(1))).astype('datetime64[s]')
+    values = {}
+    for devInd in devInds:
+        col = devInd*4+2
+        values[devInd] = (np.array(column(col+1), dtype=np.float64),
+                          np.array(column(col+0), dtype=np.float64),
+                          np.array(column(col+2), dtype=np.float64)/1000.0)
+    return (meas_time, values)
+
+#Same as parse_block for one device. Returns (times, temp, humidi, pressure).
+def parse_rows(data, devInd):
+    (meas_time, values) = parse_block(data, [devInd])
+    return (meas_time,)+values[devInd]
+
+#Reads the latest --days days of data of one device. The file is only read from
+#the first row inside the time window, so the time this takes depends on the
+#number of days shown and not on how long readRuuvi.py has been logging. The
+#data is returned as NumPy arrays. With sidecar the data is served from the
+#binary WeatherSidecar files instead, which are updated first. The last return
+#value, like in WeatherFollower and WeatherSidecar, is the number of data rows
+#of the CSV file parsed by this call. Here that is every row read from the
+#start of the window, including the few older ones the search leaves in.
+def get_weather_data(filename, devicename, days, sidecar=False):
     import numpy as np
+    if sidecar:
+        return WeatherSidecar(filename).get_weather_data(devicename, days)
     #import time
 
     #timing1 = time.perf_counter()
-    with open(filename, 'r', encoding="utf-8") as fil:
-        meas_time = []
-        temp = []
-        humidi = []
-        pressure = []
-        yLab = []
-        lines=0
-        nowTime = np.datetime64('now')
-        timeDelta = np.timedelta64(days,'D')
-        for count, line in enumerate(fil):
-            splitter = line.split(',')
-            if count==0:
-                try:
-                    devInd = splitter.index(devicename)
-                except ValueError:
-                    devInd = splitter.index(devicename+'\n')
-            elif count==1:
-                xLab = "Time"
-                #Manipulate labels to be more pleasing.
-                brac_ind = splitter[3].find('[')
-                yLab.append(splitter[3][:brac_ind] +' [°'+ splitter[3][brac_ind+1:])
-                brac_ind = splitter[2].find('[')
-                yLab.append(splitter[2][:brac_ind] +' '+ splitter[2][brac_ind:])
-                brac_ind = splitter[4].find('[')
-                yLab.append(splitter[4][:brac_ind] +' [k'+ splitter[4][brac_ind+1:]) 
-                pass
-            else:
-                if count<skip_lines:
-                    continue
-                timeFor = "{}T{}".format(splitter[0],splitter[1])
-                npTime = np.datetime64(timeFor)
-                #We want to print only the latest --days days
-                if nowTime-npTime < timeDelta:
-                    meas_time.append(npTime)
-                    temp.append(float(splitter[devInd*4+2+1]))
-                    humidi.append(float(splitter[devInd*4+2+0]))
-                    pressure.append(float(splitter[devInd*4+2+2])/1000.0)
-            lines=count
+    header = read_header(filename)
+    devInd = header["devices"].index(devicename)
+    nowTime = np.datetime64('now')
+    timeDelta = np.timedelta64(days,'D')
+    with metrics.stage("weather_read"), open(filename, 'rb') as fil:
+        fil.seek(0, os.SEEK_END)
+        file_end = fil.tell()
+        fil.seek(find_window_offset(fil, header["data_start"], file_end, nowTime-timeDelta))
+        data = fil.read()
+    #The last row might still be written by readRuuvi.py
+    data = data[:data.rfind(b'\n')+1]
+    with metrics.stage("weather_parse"):
+        (meas_time, temp, humidi, pressure) = parse_rows(data, devInd)
+    lines = len(meas_time)
+    metrics.count("weather_read", bytes_read=len(data))
+    metrics.count("weather_parse", rows=lines)
+    #We want to print only the latest --days days
+    inWindow = nowTime-meas_time < timeDelta
     #timing2 = time.perf_counter()
     #print("Reading took: ", timing2-timing1, "seconds")
 
-    #Check that if we skipped too many lines, we read the whole file
-    #so that we get some data
-    if skip_lines!=0 and len(meas_time)==0:
-        print("Too many lines skipped in get_weather_data! Reading the whole file again")
-        return get_weather_data(filename,devicename,days,0)
+    return (meas_time[inWindow], temp[inWindow], humidi[inWindow], pressure[inWindow],
+            header["xLab"], list(header["yLab"]), lines)
+
+#Follows a CSV file that readRuuvi.py keeps appending to. The last read byte
+#offset and the unfinished last line are remembered, so every update only parses
+#the rows written since the previous one. All devices of the header are parsed
+#in the same pass, so changing the shown device needs no reading at all. The
+#latest --days days are kept in a ring buffer of parsed blocks and older
+#samples are dropped. If the file is rotated (new inode) or truncated (smaller
+#than the offset), everything is read again. The last read bytes are compared
+#too, as a replaced file may get the old inode number back.
+class WeatherFollower:
+    def __init__(self,l_filename,l_days):
+        self.filename=l_filename
+        self.days=l_days
+        self.inode=None
+        self.offset=0
+        self.partial=b''
+        self.tail=b''
+        self.blocks=deque()
+
+    def set_days(self,new_days):
+        #Older rows than we have were never kept, so a longer window needs a rescan
+        if new_days>self.days:
+            self.inode=None
+        self.days=new_days
+
+    def _read_devices(self):
+        self.header = read_header(self.filename)
+        self.devInds = {dev: ind for ind,dev in enumerate(self.header["devices"])
+                        if dev and ind*4+2+2 < self.header["n_columns"]}
+
+    def _rescan(self, stat, cutoff):
+        _header_cache.pop(self.filename, None)
+        self._read_devices()
+        with open(self.filename, 'rb') as fil:
+            self.offset = find_window_offset(fil, self.header["data_start"], stat.st_size, cutoff)
+            fil.seek(max(self.offset-64, 0))
+            self.tail = fil.read(self.offset-fil.tell())
+        self.inode = stat.st_ino
+        self.partial = b''
+        self.blocks.clear()
+
+    #Checks that the bytes before the saved offset are still the ones we read
+    def _same_file(self, stat):
+        if self.inode!=stat.st_ino or stat.st_size<self.offset:
+            return False
+        with open(self.filename, 'rb') as fil:
+            fil.seek(self.offset-len(self.tail))
+            return fil.read(len(self.tail))==self.tail
+
+    #Reads the new rows and drops the expired ones. Returns the number of new rows.
+    def update(self):
+        import numpy as np
+        nowTime = np.datetime64('now')
+        timeDelta = np.timedelta64(self.days,'D')
+        stat = os.stat(self.filename)
+        if not self._same_file(stat):
+            self._rescan(stat, nowTime-timeDelta)
+
+        with metrics.stage("weather_read"), open(self.filename, 'rb') as fil:
+            fil.seek(self.offset)
+            data = fil.read()
+            self.offset = fil.tell()
+        if data:
+            self.tail = (self.tail+data)[-64:]
+        data = self.partial+data
+        end = data.rfind(b'\n')+1
+        #The rest is a row readRuuvi.py has not finished yet
+        self.partial = data[end:]
+        with metrics.stage("weather_parse"):
+            block = parse_block(data[:end], self.devInds.values())
+        lines = len(block[0])
+        metrics.count("weather_read", bytes_read=end)
+        metrics.count("weather_parse", rows=lines)
+        if lines>0:
+            self.blocks.append(block)
+
+        #Drop the expired blocks and cut the oldest remaining one
+        cutoff = nowTime-timeDelta
+        while self.blocks and self.blocks[0][0][-1] <= cutoff:
+            self.blocks.popleft()
+        if self.blocks and self.blocks[0][0][0] <= cutoff:
+            (meas_time, values) = self.blocks[0]
+            first = np.searchsorted(meas_time, cutoff, side='right')
+            self.blocks[0] = (meas_time[first:],
+                              {devInd: tuple(column[first:] for column in columns)
+                               for (devInd, columns) in values.items()})
+        return lines
+
+    #Saves where the reading stopped and the rows in memory, so that after a
+    #restart load_state() carries on from there without reading the window.
+    #Returns False if nothing has been read yet.
+    def save_state(self, filename):
+        import numpy as np
+        if self.inode is None:
+            return False
+        columns = {}
+        if self.blocks:
+            columns["meas_time"] = np.concatenate([block[0] for block in self.blocks])
+            for devInd in self.devInds.values():
+                for (name, column) in zip(("temp", "humidi", "pressure"),
+                                          zip(*(block[1][devInd] for block in self.blocks))):
+                    columns["{}_{}".format(name, devInd)] = np.concatenate(column)
+        meta = {"filename": path.abspath(self.filename),
+                "days": self.days,
+                "inode": self.inode,
+                "offset": self.offset,
+                "partial": self.partial.hex(),
+                "tail": self.tail.hex(),
+                "devInds": sorted(self.devInds.values())}
+        with open(filename+".tmp", 'wb') as fil:
+            np.savez(fil, meta=np.array(json.dumps(meta)), **columns)
+        os.replace(filename+".tmp", filename)
+        return True
+
+    #Takes the state of save_state() in use if it is of the same file, which
+    #has only grown since, and covers at least our days. Returns True if it
+    #was used, otherwise the next update reads the window as usual.
+    def load_state(self, filename):
+        import numpy as np
+        try:
+            with np.load(filename) as saved:
+                meta = json.loads(str(saved["meta"]))
+                columns = {key: saved[key] for key in saved.files if key!="meta"}
+            self._read_devices()
+        except (OSError, ValueError, KeyError) as err:
+            print("Could not load the weather state:", err)
+            return False
+        if (meta["filename"]!=path.abspath(self.filename) or meta["days"]<self.days
+                or meta["devInds"]!=sorted(self.devInds.values())):
+            return False
+        self.inode = meta["inode"]
+        self.offset = meta["offset"]
+        self.tail = bytes.fromhex(meta["tail"])
+        if not self._same_file(os.stat(self.filename)):
+            self.inode = None
+            return False
+        self.partial = bytes.fromhex(meta["partial"])
+        self.blocks.clear()
+        if "meas_time" in columns:
+            self.blocks.append((columns["meas_time"],
+                                {devInd: tuple(columns["{}_{}".format(name, devInd)]
+                                               for name in ("temp", "humidi", "pressure"))
+                                 for devInd in meta["devInds"]}))
+        return True
+
+    #Same return values as get_weather_data. Only the new rows are read, or
+    #nothing if reread is False and the data in memory is enough, so the last
+    #value, the number of CSV rows parsed by this call, is the number of new
+    #rows, and 0 when nothing was read.
+    def get_weather_data(self, devicename, reread=True):
+        import numpy as np
+        lines = self.update() if reread or self.inode is None else 0
+        devInd = self.devInds[devicename]
+        if self.blocks:
+            meas_time = np.concatenate([block[0] for block in self.blocks])
+            (temp, humidi, pressure) = (np.concatenate(column)
+                                        for column in zip(*(block[1][devInd] for block in self.blocks)))
+        else:
+            (meas_time, temp, humidi, pressure) = parse_rows(b'', devInd)
+        return (meas_time, temp, humidi, pressure, self.header["xLab"], list(self.header["yLab"]), lines)
+
+#Reduces a series to the smallest and the largest value of every pixel column.
+#The x range is split into width equally wide buckets and the min and max
+#points of each are kept in their original order, so peaks and the zero
+#crossing stay visible. Returns the indices of the kept points.
+def downsample_minmax(x_plot, y_plot, width):
+    import numpy as np
+    xNum = np.asarray(x_plot).astype(np.float64)
+    yNum = np.asarray(y_plot, dtype=np.float64)
+    span = xNum[-1]-xNum[0]
+    if span<=0:
+        return np.arange(len(yNum))
+    bucket = np.minimum(((xNum-xNum[0])/span*width).astype(np.int64), width-1)
+    #Sort by bucket and by value inside a bucket: the first and last of each
+    #bucket are then its min and max.
+    order = np.lexsort((yNum, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    ends = np.append(starts[1:], len(order))-1
+    keep = np.union1d(order[starts], order[ends])
+    return np.union1d(keep, [0, len(yNum)-1])
+
+#Largest-Triangle-Three-Buckets downsampling to n_out points. Every bucket keeps
+#the point that makes the largest triangle with the previously kept point and
+#the average of the next bucket. Returns the indices of the kept points.
+def downsample_lttb(x_plot, y_plot, n_out):
+    import numpy as np
+    xNum = np.asarray(x_plot).astype(np.float64)
+    yNum = np.asarray(y_plot, dtype=np.float64)
+    nIn = len(yNum)
+    if n_out>=nIn or n_out<3:
+        return np.arange(nIn)
+    edges = np.linspace(1, nIn-1, n_out-1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = nIn-1
+    for ib in range(n_out-2):
+        (start, end) = (edges[ib], edges[ib+1])
+        nextEnd = edges[ib+2] if ib+2<len(edges) else nIn
+        avgX = xNum[end:nextEnd].mean()
+        avgY = yNum[end:nextEnd].mean()
+        (prevX, prevY) = (xNum[keep[ib]], yNum[keep[ib]])
+        area = np.abs((prevX-avgX)*(yNum[start:end]-prevY)-(prevX-xNum[start:end])*(avgY-prevY))
+        keep[ib+1] = start+np.argmax(area)
+    return keep
+
+#Downsamples a series for a plot that is width pixels wide, about two points
+#per pixel column. method is "minmax" or "lttb". Short series are returned as is.
+def downsample(x_plot, y_plot, width, method="minmax"):
+    import numpy as np
+    width = max(int(width), 1)
+    if len(y_plot)<=2*width:
+        return (x_plot, y_plot)
+    if method=="lttb":
+        keep = downsample_lttb(x_plot, y_plot, 2*width)
     else:
-        return (meas_time, temp, humidi, pressure, xLab, yLab, lines)
+        keep = downsample_minmax(x_plot, y_plot, width)
+    return (np.asarray(x_plot)[keep], np.asarray(y_plot)[keep])
+
+#Binary sidecar of a weather CSV file. Every device gets one fixed-width record
+#file per column next to the CSV (weather.csv.cache/<device>.<column>.bin):
+#times as int64 seconds and temperature, humidity and pressure [kPa] as float32.
+#The files are appended when the CSV grows and built again if the CSV is
+#replaced or its size or mtime goes backwards. Reading is a memory map and a
+#searchsorted, so any time range is served without parsing or copying. The CSV
+#is read and appended in chunks of whole lines, so building the sidecar of a
+#file of several years does not need the whole file in memory.
+class WeatherSidecar:
+    columns = (("time", "int64"), ("temp", "float32"), ("humidi", "float32"), ("pressure", "float32"))
+    chunk_size = 1024*1024
+
+    def __init__(self,l_filename):
+        self.filename=l_filename
+        self.folder=l_filename+".cache"
+
+    def _column_path(self, devicename, column):
+        return path.join(self.folder, "{}.{}.bin".format(devicename.replace(':',''), column))
+
+    def _read_meta(self):
+        try:
+            with open(path.join(self.folder, "meta.json"), 'r', encoding="utf-8") as fil:
+                return json.load(fil)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta):
+        tmp = path.join(self.folder, "meta.json.tmp")
+        with open(tmp, 'w', encoding="utf-8") as fil:
+            json.dump(meta, fil)
+        os.replace(tmp, path.join(self.folder, "meta.json"))
+
+    def _rebuild(self, stat):
+        header = read_header(self.filename)
+        os.makedirs(self.folder, exist_ok=True)
+        devices = [dev for ind,dev in enumerate(header["devices"])
+                   if dev and ind*4+2+2 < header["n_columns"]]
+        for dev in devices:
+            for (column, dtype) in self.columns:
+                open(self._column_path(dev, column), 'wb').close()
+        return {"inode": stat.st_ino,
+                "size": 0,
+                "mtime": 0,
+                "offset": header["data_start"],
+                "records": 0,
+                "devices": devices}
+
+    #Appends the rows written after the last update. Returns the number of new rows.
+    def update(self):
+        import numpy as np
+        stat = os.stat(self.filename)
+        meta = self._read_meta()
+        if (not meta or meta["inode"]!=stat.st_ino or stat.st_size<meta["size"]
+                or stat.st_mtime<meta["mtime"]):
+            _header_cache.pop(self.filename, None)
+            meta = self._rebuild(stat)
+
+        header = read_header(self.filename)
+        devInds = {dev: header["devices"].index(dev) for dev in meta["devices"]}
+        meta["size"] = stat.st_size
+        meta["mtime"] = stat.st_mtime
+        new_rows = 0
+        with open(self.filename, 'rb') as csv_fil:
+            csv_fil.seek(meta["offset"])
+            while meta["offset"]<stat.st_size:
+                data = csv_fil.read(min(self.chunk_size, stat.st_size-meta["offset"]))
+                #The chunk ends at the last whole line. The last row might
+                #still be written by readRuuvi.py.
+                end = data.rfind(b'\n')+1
+                if end==0:
+                    if len(data)<self.chunk_size:
+                        break
+                    #A line longer than a chunk, read on until its end
+                    line_end = csv_fil.readline()
+                    if not line_end.endswith(b'\n'):
+                        break
+                    data += line_end
+                    end = len(data)
+                csv_fil.seek(meta["offset"]+end)
+                (meas_time, values) = parse_block(data[:end], devInds.values())
+                for (dev, devInd) in devInds.items():
+                    records = (meas_time.astype(np.int64),)+values[devInd]
+                    for ((column, dtype), record) in zip(self.columns, records):
+                        with open(self._column_path(dev, column), 'r+b') as fil:
+                            #Anything after the saved record count is from an interrupted update
+                            fil.truncate(meta["records"]*np.dtype(dtype).itemsize)
+                            fil.seek(0, os.SEEK_END)
+                            record.astype(dtype).tofile(fil)
+                #Saved after every chunk, so an interrupted build goes on from here
+                meta["offset"] += end
+                meta["records"] += len(meas_time)
+                new_rows += len(meas_time)
+                self._write_meta(meta)
+        if new_rows==0:
+            self._write_meta(meta)
+        return new_rows
+
+    #Memory maps one column of a device, or gives an empty array if there is no data
+    def _map_column(self, devicename, column, dtype, records):
+        import numpy as np
+        if records==0:
+            return np.array([], dtype=dtype)
+        return np.memmap(self._column_path(devicename, column), dtype=dtype, mode='r', shape=(records,))
+
+    #Same return values as get_weather_data. The arrays are read-only views of
+    #the memory mapped sidecar files. The last value, the number of CSV rows
+    #parsed by this call, is the number of rows appended to the sidecar files.
+    def get_weather_data(self, devicename, days):
+        import numpy as np
+        lines = self.update()
+        meta = self._read_meta()
+        if devicename not in meta["devices"]:
+            raise ValueError("{} is not a device in {}".format(devicename, self.filename))
+        (meas_time, temp, humidi, pressure) = (self._map_column(devicename, column, dtype, meta["records"])
+                                               for (column, dtype) in self.columns)
+        meas_time = meas_time.view('datetime64[s]')
+        cutoff = np.datetime64('now')-np.timedelta64(days,'D')
+        first = np.searchsorted(meas_time, cutoff, side='right')
+        header = read_header(self.filename)
+        return (meas_time[first:], temp[first:], humidi[first:], pressure[first:],
+                header["xLab"], list(header["yLab"]), lines)
 
 if __name__ == "__main__":
     import argparse
@@ -80,6 +525,14 @@ if __name__ == "__main__":
                         help="How many days are printed",
                         type=int,
                         default=10)
+    parser.add_argument("--sidecar",
+                        "-s",
+                        help="Keep a binary copy of the file next to it and read the data from there",
+                        action="store_true")
+    parser.add_argument("--downsample",
+                        help="How the data is reduced to the width of the figure",
+                        choices=["minmax", "lttb"],
+                        default="minmax")
     parser.add_argument("--quiet",
                         "-q",
                         help="Use without output",
@@ -96,7 +549,7 @@ if __name__ == "__main__":
     yLab = []
     xLab = None
 
-    (time, temp, humidi, pressure, xLab, yLab, lines) = get_weather_data(args.file, args.device, args.days)
+    (time, temp, humidi, pressure, xLab, yLab, lines) = get_weather_data(args.file, args.device, args.days, args.sidecar)
 
     if len(time)==0:
         print("No data found, exiting...")
@@ -122,7 +575,9 @@ if __name__ == "__main__":
         ax[ix].spines['bottom'].set_color(plot_color)
         ax[ix].spines['left'].set_color(plot_color)
         ax[ix].spines['right'].set_color(plot_color)
-    ax[0].plot(time,temp)#,label=label1[num])
+    #There is no use in drawing more points than the axes have pixels
+    plot_width = fig.get_size_inches()[0]*fig.dpi
+    ax[0].plot(*downsample(time,temp,plot_width,args.downsample))#,label=label1[num])
 
     #Draw zero-line only if there are both neg and pos values
     posVal=False
@@ -136,8 +591,8 @@ if __name__ == "__main__":
     if posVal and negVal:
         ax[0].axhline(y=0, color="grey", linestyle='--')
 
-    ax[1].plot(time,humidi)#,label=label1[num])
-    ax[2].plot(time,pressure)#,label=label1[num])
+    ax[1].plot(*downsample(time,humidi,plot_width,args.downsample))#,label=label1[num])
+    ax[2].plot(*downsample(time,pressure,plot_width,args.downsample))#,label=label1[num])
 
     #Plot time so it is easy to check
     textposX = 0.126#0.1*ax[0].get_xlim()[1]
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+#Timing of the stages of a refresh: reading and parsing the weather file,
+#plotting, the picture, packing the frame and the refresh of the display.
+#Every stage keeps the wall times of its last window runs, from which the
+#percentiles are taken, and the totals of the rows parsed and bytes read.
+#The process RSS is taken at the end of each stage. The numbers can be
+#written as a Prometheus textfile collector file and as a JSON status file.
+#
+#Collection is off until enable() is called. Until then stage() gives the same
+#do-nothing context manager and count() returns at once, so the instrumented
+#code pays only for a function call.
+
+enabled = False
+window = 256
+_stages = {}
+_lock = threading.Lock()
+_noop = nullcontext()
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def enable(new_window=256):
+    global enabled, window
+    window = new_window
+    enabled = True
+
+#The resident set size of this process in bytes, 0 if it cannot be read
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as fil:
+            return int(fil.read().split()[1])*_page_size
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        import resource
+        #The peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    except ImportError:
+        return 0
+
+class _Stage:
+    def __init__(self):
+        self.times = deque(maxlen=window)
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes_read = 0
+        self.rss = 0
+
+def _get_stage(name):
+    stage = _stages.get(name)
+    if stage is None:
+        with _lock:
+            stage = _stages.setdefault(name, _Stage())
+    return stage
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter()-self.start
+        stage = _get_stage(self.name)
+        with _lock:
+            stage.times.append(seconds)
+            stage.count += 1
+            stage.seconds += seconds
+            stage.rss = rss_bytes()
+        return False
+
+#Times the with block as the stage name: with metrics.stage("plot"): ...
+def stage(name):
+    if not enabled:
+        return _noop
+    return _Timer(name)
+
+#Adds rows parsed and bytes read to the stage name
+def count(name, rows=0, bytes_read=0):
+    if not enabled:
+        return
+    stage = _get_stage(name)
+    with _lock:
+        stage.rows += rows
+        stage.bytes_read += bytes_read
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(fraction*len(ordered)), len(ordered)-1)]
+
+#Gives the runs, min, median, p95 and max of a list of times
+def summarize(times):
+    ordered = sorted(times)
+    return {"runs": len(ordered),
+            "min": ordered[0],
+            "median": _percentile(ordered, 0.5),
+            "p95": _percentile(ordered, 0.95),
+            "max": ordered[-1]}
+
+#Gives the numbers of all stages as a dict that can be written as JSON
+def snapshot():
+    stages = {}
+    with _lock:
+        for (name, stage) in sorted(_stages.items()):
+            ordered = sorted(stage.times)
+            stages[name] = {"count": stage.count,
+                            "seconds_total": stage.seconds,
+                            "last": stage.times[-1] if stage.times else None,
+                            "p50": _percentile(ordered, 0.5) if ordered else None,
+                            "p90": _percentile(ordered, 0.9) if ordered else None,
+                            "p99": _percentile(ordered, 0.99) if ordered else None,
+                            "max": ordered[-1] if ordered else None,
+                            "rows_total": stage.rows,
+                            "bytes_read_total": stage.bytes_read,
+                            "rss_bytes": stage.rss}
+    return {"time": time.time(), "rss_bytes": rss_bytes(), "stages": stages}
+
+#Writes the file so that a reader never sees it half written
+def _write_atomic(filename, text):
+    with open(filename+".tmp", "w") as fil:
+        fil.write(text)
+    os.replace(filename+".tmp", filename)
+
+def write_json(filename):
+    _write_atomic(filename, json.dumps(snapshot(), indent=1))
+
+#Writes the numbers in the Prometheus text format, for the textfile collector
+#of node_exporter. The file name has to end with .prom.
+def write_prometheus(filename, prefix="edisplay"):
+    status = snapshot()
+    lines = ["# HELP {}_stage_seconds Wall time of a stage of the display refresh.".format(prefix),
+             "# TYPE {}_stage_seconds summary".format(prefix)]
+    for (name, stage) in status["stages"].items():
+        for (key, quantile) in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+            if stage[key] is not None:
+                lines.append('{}_stage_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                    prefix, name, quantile, stage[key]))
+        lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(prefix, name, stage["seconds_total"]))
+        lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, stage["count"]))
+    for (key, help_text) in (("rows_total", "Rows of the weather file parsed by a stage."),
+                             ("bytes_read_total", "Bytes of the weather file read by a stage.")):
+        lines.append("# HELP {}_stage_{} {}".format(prefix, key, help_text))
+        lines.append("# TYPE {}_stage_{} counter".format(prefix, key))
+        for (name, stage) in status["stages"].items():
+            if stage[key]:
+                lines.append('{}_stage_{}{{stage="{}"}} {}'.format(prefix, key, name, stage[key]))
+    lines.append("# HELP {}_rss_bytes Resident memory of the display process.".format(prefix))
+    lines.append("# TYPE {}_rss_bytes gauge".format(prefix))
+    lines.append("{}_rss_bytes {}".format(prefix, status["rss_bytes"]))
+    _write_atomic(filename, "\n".join(lines)+"\n")
@@ -0,0 +1,130 @@
+import argparse
+from datetime import datetime, date
+
+#Sunrise and sunset from the NOAA solar calculator equations, so the sun view
+#does not need timeanddate.com. The equations are evaluated with numpy for a
+#whole array of days at once, which makes a table for a year cheap enough to
+#be made at startup. The times agree with timeanddate.com within a minute.
+
+#Jyväskylä
+DEFAULT_LATITUDE = 62.2415
+DEFAULT_LONGITUDE = 25.7209
+
+#The sun is up when its centre is 0.833 degrees below the horizon, this takes
+#the refraction of the atmosphere and the radius of the sun into account
+SUNRISE_ZENITH = 90.833
+
+#Gives the declination of the sun in radians and the equation of time in minutes
+#at the given julian days
+def _sun_position(jd):
+    import numpy as np
+    t = (jd-2451545.0)/36525.0
+    geom_mean_long = np.radians((280.46646+t*(36000.76983+t*0.0003032))%360)
+    geom_mean_anom = np.radians(357.52911+t*(35999.05029-0.0001537*t))
+    eccent = 0.016708634-t*(0.000042037+0.0000001267*t)
+    eq_of_ctr = (np.sin(geom_mean_anom)*(1.914602-t*(0.004817+0.000014*t))
+                 +np.sin(2*geom_mean_anom)*(0.019993-0.000101*t)
+                 +np.sin(3*geom_mean_anom)*0.000289)
+    true_long = np.degrees(geom_mean_long)+eq_of_ctr
+    omega = np.radians(125.04-1934.136*t)
+    app_long = np.radians(true_long-0.00569-0.00478*np.sin(omega))
+    mean_obliq = 23+(26+(21.448-t*(46.815+t*(0.00059-t*0.001813)))/60)/60
+    obliq = np.radians(mean_obliq+0.00256*np.cos(omega))
+    declination = np.arcsin(np.sin(obliq)*np.sin(app_long))
+    var_y = np.tan(obliq/2)**2
+    eq_of_time = 4*np.degrees(var_y*np.sin(2*geom_mean_long)
+                              -2*eccent*np.sin(geom_mean_anom)
+                              +4*eccent*var_y*np.sin(geom_mean_anom)*np.cos(2*geom_mean_long)
+                              -0.5*var_y**2*np.sin(4*geom_mean_long)
+                              -1.25*eccent**2*np.sin(2*geom_mean_anom))
+    return (declination, eq_of_time)
+
+#Gives the cosine of the hour angle of sunrise, over 1 if the sun stays down
+#and under -1 if it stays up the whole day
+def _cos_hour_angle(latitude, declination):
+    import numpy as np
+    lat = np.radians(latitude)
+    return (np.cos(np.radians(SUNRISE_ZENITH))/(np.cos(lat)*np.cos(declination))
+            -np.tan(lat)*np.tan(declination))
+
+#Gives the sunrise and sunset of the given days (datetime64[D] array) as unix
+#times in seconds (float arrays, nan when there is none) and the state of the
+#day: 0 for a normal day, 1 for a nightless night and -1 for a sunless day.
+#The position of the sun is first taken at the solar noon, and then again at
+#the approximate sunrise and sunset, which moves them by up to a minute.
+def sun_events(days, latitude=DEFAULT_LATITUDE, longitude=DEFAULT_LONGITUDE):
+    import numpy as np
+    days = np.asarray(days, dtype='datetime64[D]')
+    midnight = days.astype('datetime64[s]').astype(np.float64)
+    #Julian day of the midnight in UTC
+    jd_midnight = midnight/86400.0+2440587.5
+
+    (declination, eq_of_time) = _sun_position(jd_midnight+0.5-longitude/360.0)
+    noon = 720-4*longitude-eq_of_time
+    cos_ha = _cos_hour_angle(latitude, declination)
+    state = np.where(cos_ha>1, -1, np.where(cos_ha<-1, 1, 0))
+
+    events = []
+    for sign in (-1, 1):
+        half_day = 4*np.degrees(np.arccos(np.clip(cos_ha, -1, 1)))
+        approx = noon+sign*half_day
+        (declination, eq_of_time) = _sun_position(jd_midnight+approx/1440.0)
+        half_day = 4*np.degrees(np.arccos(np.clip(_cos_hour_angle(latitude, declination), -1, 1)))
+        minutes = 720-4*longitude-eq_of_time+sign*half_day
+        events.append(np.where(state==0, midnight+minutes*60, np.nan))
+    return (events[0], events[1], state)
+
+#Sun info of a year computed once. sun_info() gives the same tuple as
+#find_sun_info in display_continuous.py, in the local time of the computer.
+class SunTable:
+    def __init__(self,l_latitude=DEFAULT_LATITUDE,l_longitude=DEFAULT_LONGITUDE,l_year=None):
+        self.latitude=l_latitude
+        self.longitude=l_longitude
+        self.year=None
+        self.make_table(l_year if l_year else date.today().year)
+
+    def make_table(self,year):
+        import numpy as np
+        self.year=year
+        self.first_day=np.datetime64("{}-01-01".format(year), 'D')
+        days=np.arange(self.first_day, np.datetime64("{}-01-01".format(year+1), 'D'))
+        (self.sunrise, self.sunset, self.state) = sun_events(days, self.latitude, self.longitude)
+
+    #Returns (length_of_day, sunrise, sundown) as ("H:MM:SS", "HH.MM", "HH.MM"),
+    #or ("nightless",)*3 or ("sunless",)*3 when the sun does not set or rise.
+    def sun_info(self,day=None):
+        import numpy as np
+        if day is None:
+            day = date.today()
+        if day.year!=self.year:
+            self.make_table(day.year)
+        ind = int((np.datetime64(day, 'D')-self.first_day).astype(int))
+        if self.state[ind]==1:
+            return ("nightless","nightless","nightless")
+        if self.state[ind]==-1:
+            return ("sunless","sunless","sunless")
+        length = int(round(self.sunset[ind]-self.sunrise[ind]))
+        length_of_day = "{}:{:02d}:{:02d}".format(length//3600, length//60%60, length%60)
+        #Rounded to the nearest minute like timeanddate.com does
+        sunrise = datetime.fromtimestamp(round(self.sunrise[ind]/60)*60)
+        sundown = datetime.fromtimestamp(round(self.sunset[ind]/60)*60)
+        return (length_of_day, sunrise.strftime("%H.%M"), sundown.strftime("%H.%M"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the length of day, sunrise and sunset of a day, computed locally with the NOAA solar equations.",
+                                     epilog="Created by OS")
+    parser.add_argument("--date",
+                        "-d",
+                        help="The day as YYYY-MM-DD, today by default.",
+                        default=None)
+    parser.add_argument("--latitude",
+                        help="Latitude in degrees, north is positive.",
+                        type=float,
+                        default=DEFAULT_LATITUDE)
+    parser.add_argument("--longitude",
+                        help="Longitude in degrees, east is positive.",
+                        type=float,
+                        default=DEFAULT_LONGITUDE)
+    args = parser.parse_args()
+    day = date.fromisoformat(args.date) if args.date else date.today()
+    print(SunTable(args.latitude, args.longitude, day.year).sun_info(day))
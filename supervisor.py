@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import argparse
+import fcntl
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+#Keeps display_continuous.py running. The supervisor starts it with --daemon,
+#restarts it at once when it exits, and kills and restarts it when its
+#heartbeat file has not been touched for --hangtimeout seconds, which also
+#catches a display() that never returns. Only one supervisor runs at a time,
+#a second one exits at once, so it can be started from cron every few
+#minutes (check_instance.sh) without looking through ps.
+#
+#The helpers for the single instance lock, the heartbeat and the systemd
+#notifications are used by display_continuous.py --daemon too. This file does
+#not import anything heavy, so the supervisor stays small.
+
+DEFAULT_LOCKFILE = path.join(tempfile.gettempdir(), "e-display.lock")
+DEFAULT_HEARTBEAT = path.join(tempfile.gettempdir(), "e-display.heartbeat")
+
+#Takes an exclusive flock on lockfile and writes our pid in it. Returns the
+#open file, which has to be kept open for as long as the lock is held, or
+#None if another process already has the lock.
+def acquire_lock(lockfile):
+    fil = open(lockfile, "a+")
+    try:
+        fcntl.flock(fil, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fil.close()
+        return None
+    fil.seek(0)
+    fil.truncate()
+    fil.write("{}\n".format(os.getpid()))
+    fil.flush()
+    return fil
+
+#Gives the pid written in lockfile, or None
+def lock_owner(lockfile):
+    try:
+        with open(lockfile) as fil:
+            return int(fil.read().strip())
+    except (OSError, ValueError):
+        return None
+
+#Sends a state like "READY=1" or "WATCHDOG=1" to systemd, if we were started
+#by a service with Type=notify. Does nothing otherwise.
+def sd_notify(state):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        #Abstract socket
+        address = "\0"+address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode("utf-8"))
+        return True
+    except OSError:
+        return False
+
+#Writes the current time in the heartbeat file. The supervisor only looks at
+#the modification time.
+def beat(heartbeat):
+    with open(heartbeat+".tmp", "w") as fil:
+        fil.write("{:.0f}\n".format(time.time()))
+    os.replace(heartbeat+".tmp", heartbeat)
+
+def heartbeat_age(heartbeat):
+    try:
+        return time.time()-os.stat(heartbeat).st_mtime
+    except OSError:
+        return None
+
+def _stop(child, wait=10):
+    if child.poll() is not None:
+        return
+    child.terminate()
+    try:
+        child.wait(wait)
+    except subprocess.TimeoutExpired:
+        child.kill()
+        child.wait()
+
+#Runs command until the supervisor is stopped. A child that exits is
+#restarted at once, or after a growing pause if it dies again right after
+#the restart. A child whose heartbeat is older than hang_timeout is killed and
+#restarted, start_grace seconds are given for the first heartbeat.
+def supervise(command, heartbeat, hang_timeout=90, start_grace=120, poll=2):
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    #The child talks to us through the heartbeat, not to systemd
+    env = dict(os.environ)
+    env.pop("NOTIFY_SOCKET", None)
+    quick_exits = 0
+    while not stopping:
+        if path.exists(heartbeat):
+            os.remove(heartbeat)
+        started = time.time()
+        print("Starting:", " ".join(command), flush=True)
+        child = subprocess.Popen(command, env=env)
+        while not stopping and child.poll() is None:
+            time.sleep(poll)
+            age = heartbeat_age(heartbeat)
+            if age is None:
+                if time.time()-started > start_grace:
+                    print("No heartbeat in {} s, restarting".format(start_grace), flush=True)
+                    break
+            elif age > hang_timeout:
+                print("Heartbeat is {:.0f} s old, the display is hung, restarting".format(age), flush=True)
+                break
+        _stop(child)
+        if stopping:
+            break
+        print("Exited with code", child.returncode, flush=True)
+        #Restart at once, unless it keeps dying right after the start
+        quick_exits = quick_exits+1 if time.time()-started < 60 else 0
+        if quick_exits>1:
+            time.sleep(min(5*2**(quick_exits-2), 300))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keeps display_continuous.py running, and restarts it at once if it dies or its heartbeat stops. Exits at once if a supervisor is already running. The arguments after -- are given to display_continuous.py.",
+                                     epilog="Created by OS")
+    parser.add_argument("--lockfile",
+                        help="Lock file of the supervisor.",
+                        default=path.join(tempfile.gettempdir(), "e-display-supervisor.lock"))
+    parser.add_argument("--heartbeat",
+                        help="Heartbeat file display_continuous.py touches while it works.",
+                        default=DEFAULT_HEARTBEAT)
+    parser.add_argument("--hangtimeout",
+                        help="Restart display_continuous.py if the heartbeat is older than this many seconds.",
+                        type=float,
+                        default=90)
+    parser.add_argument("--startgrace",
+                        help="Seconds display_continuous.py has for its first heartbeat.",
+                        type=float,
+                        default=120)
+    parser.add_argument("display_args",
+                        help="Arguments of display_continuous.py.",
+                        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    lock = acquire_lock(args.lockfile)
+    if not lock:
+        print("Supervisor already running (pid {}), exiting".format(lock_owner(args.lockfile)))
+        exit()
+    display_args = args.display_args[1:] if args.display_args[:1]==["--"] else args.display_args
+    command = [sys.executable, path.join(path.dirname(path.abspath(__file__)), "display_continuous.py"),
+               "--daemon", "--heartbeat", args.heartbeat]+display_args
+    supervise(command, args.heartbeat, args.hangtimeout, args.startgrace)
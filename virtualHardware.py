@@ -0,0 +1,185 @@
+import os
+import time
+from os import path
+
+#Stand-ins for the e-ink bonnet, so display_continuous.py can be run and timed
+#on an ordinary computer (--backend virtual). The display keeps its frames in
+#the same 1-bit buffers as Adafruit_SSD1680, so pack_image() and FramePusher
+#work on it unchanged, and display() takes about as long as the real panel.
+
+#A 1-bit framebuffer with the attributes of adafruit_framebuf that
+#pack_image() uses. Rows are stride bits wide, most significant bit first.
+class VirtualFramebuf:
+    def __init__(self,l_buf,l_width,l_height,l_stride):
+        self.buf=l_buf
+        self.width=l_width
+        self.height=l_height
+        self.stride=l_stride
+        self.rotation=0
+
+#The inverse of _unrotate_plane() in display_continuous.py, from the panel
+#memory to the way the frame is seen
+def _rotate_plane(plane, rotation):
+    if rotation==1:
+        return plane[:, ::-1].T
+    if rotation==2:
+        return plane[::-1, ::-1]
+    if rotation==3:
+        return plane[::-1, :].T
+    return plane
+
+#Virtual SSD1680. The frames are written in the buffers by pack_image(), there
+#is no slow image() like in Adafruit_EPD. The black plane is inverted and the
+#red one is not, like on the real panel. Every refresh is written to the
+#output folder, if one is given, as frame_00001.png, ... or as the raw black
+#and red buffers (frame_00001.bin) with output_format "raw". display() and
+#partial_display() sleep for the time the SPI transfer and the refresh of the
+#panel would take, a partial refresh sends its window of the RAM three times
+#like PartialSSD1680.
+class VirtualSSD1680:
+    BLACK = 0
+    WHITE = 1
+    INVERSE = 2
+    RED = 3
+
+    def __init__(self,l_width,l_height,l_output=None,l_output_format="png",
+                 l_full_busy=2.0,l_partial_busy=0.4,l_baudrate=1000000):
+        self._width=l_width
+        self._height=l_height
+        #The rows of the panel are padded to whole bytes
+        stride=(l_width+7)//8*8
+        self._buffer1=bytearray(stride*l_height//8)
+        self._buffer2=bytearray(stride*l_height//8)
+        self._blackframebuf=VirtualFramebuf(self._buffer1, l_width, l_height, stride)
+        self._colorframebuf=VirtualFramebuf(self._buffer2, l_width, l_height, stride)
+        self._black_inverted=True
+        self._color_inverted=False
+        self.sram=None
+        self.output=l_output
+        self.output_format=l_output_format
+        self.full_busy=l_full_busy
+        self.partial_busy=l_partial_busy
+        self.baudrate=l_baudrate
+        self.frames=0
+        self.full_refreshes=0
+        self.partial_refreshes=0
+        #The time the last display() or partial_display() took
+        self.last_refresh_time=0
+        self._busy_time=0
+        if self.output:
+            os.makedirs(self.output, exist_ok=True)
+        self.fill(self.WHITE)
+
+    @property
+    def rotation(self):
+        return self._blackframebuf.rotation
+
+    @rotation.setter
+    def rotation(self,value):
+        self._blackframebuf.rotation=value%4
+        self._colorframebuf.rotation=value%4
+
+    @property
+    def width(self):
+        return self._height if self.rotation in (1,3) else self._width
+
+    @property
+    def height(self):
+        return self._width if self.rotation in (1,3) else self._height
+
+    def fill(self,color):
+        black = color==self.BLACK
+        red = color==self.RED
+        self._buffer1[:] = bytes([0x00 if black else 0xFF])*len(self._buffer1)
+        self._buffer2[:] = bytes([0xFF if red else 0x00])*len(self._buffer2)
+
+    #Gives the frame on the panel as a PIL image, in the rotation of the display
+    def frame_image(self):
+        import numpy as np
+        from PIL import Image
+        planes = []
+        for (framebuf, inverted) in ((self._blackframebuf, self._black_inverted),
+                                     (self._colorframebuf, self._color_inverted)):
+            bits = np.unpackbits(np.frombuffer(framebuf.buf, dtype=np.uint8), bitorder='big')
+            plane = bits.reshape(framebuf.height, framebuf.stride)[:, :framebuf.width].astype(bool)
+            if inverted:
+                plane = ~plane
+            planes.append(_rotate_plane(plane, self.rotation))
+        pixels = np.full(planes[0].shape+(3,), 255, dtype=np.uint8)
+        pixels[planes[1]] = (255, 0, 0)
+        pixels[planes[0]] = (0, 0, 0)
+        return Image.fromarray(pixels)
+
+    def _transfer_time(self,n_bytes=None):
+        if n_bytes is None:
+            n_bytes = len(self._buffer1)+len(self._buffer2)
+        return 8*n_bytes/self.baudrate
+
+    #Waits like the driver does for the busy pin while the panel refreshes
+    def busy_wait(self):
+        time.sleep(self._busy_time)
+
+    def _refresh(self,busy,n_bytes=None):
+        timing1 = time.perf_counter()
+        self.frames+=1
+        if self.output:
+            name = path.join(self.output, "frame_{:05d}".format(self.frames))
+            if self.output_format=="raw":
+                with open(name+".bin", "wb") as fil:
+                    fil.write(bytes(self._buffer1)+bytes(self._buffer2))
+            else:
+                self.frame_image().save(name+".png")
+        #Sleep what is left of the transfer time, then the refresh of the panel
+        time.sleep(max(self._transfer_time(n_bytes)-(time.perf_counter()-timing1), 0))
+        self._busy_time = busy
+        self.busy_wait()
+        self.last_refresh_time = time.perf_counter()-timing1
+
+    def display(self):
+        self.full_refreshes+=1
+        self._refresh(self.full_busy)
+
+    #window is (first byte, last byte, first row, last row) of the buffers,
+    #None for all of them
+    def partial_display(self,previous_black,window=None):
+        self.partial_refreshes+=1
+        n_bytes = len(self._buffer1)
+        if window is not None:
+            (x_first, x_last, y_first, y_last) = window
+            n_bytes = (x_last-x_first+1)*(y_last-y_first+1)
+        self._refresh(self.partial_busy, 3*n_bytes)
+
+#A button of which the presses are scripted. value is False (pressed) for
+#press_length seconds from each of the press times, counted in seconds from
+#when the button was made. press() presses it now.
+class VirtualButton:
+    def __init__(self,l_press_times=(),l_press_length=0.1):
+        self.start=time.monotonic()
+        self.press_times=sorted(l_press_times)
+        self.press_length=l_press_length
+
+    def switch_to_input(self):
+        pass
+
+    def press(self):
+        self.press_times.append(time.monotonic()-self.start)
+
+    @property
+    def value(self):
+        now = time.monotonic()-self.start
+        for pressed_at in self.press_times:
+            if pressed_at<=now<pressed_at+self.press_length:
+                return False
+        return True
+
+#Makes the virtual buttons from a script like "1:2.0,2:4.0,2:4.2", which
+#presses button 1 two seconds after the start and button 2 twice two seconds
+#later. Returns a list of the buttons 1..n_buttons.
+def scripted_buttons(script,n_buttons=2):
+    press_times = [[] for i in range(n_buttons)]
+    for press in (script or "").split(','):
+        if not press.strip():
+            continue
+        (button, pressed_at) = press.split(':')
+        press_times[int(button)-1].append(float(pressed_at))
+    return [VirtualButton(times) for times in press_times]